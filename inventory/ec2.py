@@ -95,12 +95,58 @@ consistency with variable spellings (camelCase and underscores) since this
 just loops through all variables the object exposes. It is preferred to use the
 ones with underscores when multiple exist.
 
+ec2_association, ec2_attachment, ec2_attachTime, ec2_attachmentId,
+ec2_deleteOnTermination, ec2_description, ec2_deviceIndex, ec2_instanceState,
+ec2_ipOwnerId, ec2_networkInterfaceId, ec2_ownerId, ec2_publicIp,
+ec2_shutdown_state, ec2_status and ec2_tenancy are only set by older boto
+releases, which left the elements of the primary network interface and the
+placement on the instance. Recent releases, and 'instance_fetch_backend =
+boto3', don't set them.
+
 In addition, if an instance has AWS Tags associated with it, each tag is a new
 variable named:
  - ec2_tag_[Key] = [Value]
 
 Security groups are comma-separated in 'ec2_security_group_ids' and
 'ec2_security_group_names'.
+
+To keep the output small, set 'hostvars_include' and/or 'hostvars_exclude' in
+ec2.ini to comma-separated globs (or regular expressions prefixed with 're:')
+of the variable names to build, e.g.:
+
+    hostvars_include = ec2_tag_*, ec2_private_ip_address, ec2_id
+
+Variables that are left out are never computed. 'ansible_ssh_host' is always
+set. --host finds hosts by IP address or Name tag without calling AWS only
+when 'ec2_private_ip_address' and 'ec2_tag_Name' are kept.
+
+With 'hoist_group_vars = True', a variable that has the same value for every
+host of a group (e.g. 'ec2_vpc_id' in a 'vpc_id_*' group) is written once, in
+the 'vars' of the group, rather than for each host. Ansible resolves the same
+variables either way; --host still returns all of them.
+
+To fetch several AWS accounts into one inventory, add a section per account
+to ec2.ini, each with the role to assume and/or the boto profile to use, and
+optionally its own regions and instance_filters:
+
+    [account:prod]
+    iam_role = arn:aws:iam::123456789012:role/ansible-inventory
+    regions = us-east-1,us-west-2
+
+    [account:staging]
+    boto_profile = staging
+    instance_filters = tag:app=bluebutton
+
+Only the accounts listed are then fetched, all at once (see max_workers), and
+hosts are grouped and tagged with their own account ID (see
+group_by_aws_account and ec2_account_id). Route53 names are still looked up
+with the [ec2] credentials. Each account's results are kept in the cache on
+their own, and an account that can't be refreshed is added from the last
+results fetched for it, with a warning, as long as they are younger than
+'snapshot_max_age' (default: 86400 seconds, 0 for no limit). An account that
+is still being fetched 'fetch_timeout' seconds after its first fetch started
+(default: 60, 0 to wait for it) is added from those results too, so that one
+slow account doesn't hold up the others. Both can be set in [ec2] or per account.
 '''
 
 # (c) 2012, Peter Sankauskas
@@ -124,37 +170,1083 @@ Security groups are comma-separated in 'ec2_security_group_ids' and
 
 import sys
 import os
+import io
+import socket
+import gzip
+import shutil
 import argparse
 import re
+import fnmatch
+import random
+import calendar
+import hashlib
+import time as time_module
+import importlib
 from time import time
-import boto
-from boto import ec2
-from boto import rds
-from boto import elasticache
-from boto import route53
-from boto import sts
-import six
 
-from ansible.module_utils import ec2 as ec2_utils
+# When the script started, for EC2_STARTUP_BUDGET
+SCRIPT_START = time()
+
+# boto and boto3 take longer to import than answering from the cache does,
+# so they are only imported by the code that talks to AWS
+
+try:
+    import configparser
+    import queue
+    import socketserver
+except ImportError:
+    import ConfigParser as configparser
+    import Queue as queue
+    import SocketServer as socketserver
+from collections import defaultdict
+from functools import partial
+from itertools import chain
+from contextlib import contextmanager
+import threading
 
-HAS_BOTO3 = False
+HAS_FCNTL = False
 try:
-    import boto3
-    HAS_BOTO3 = True
+    import fcntl
+    HAS_FCNTL = True
 except ImportError:
     pass
 
-from six.moves import configparser
-from collections import defaultdict
+HAS_SQLITE = False
+try:
+    import sqlite3
+    HAS_SQLITE = True
+except ImportError:
+    pass
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    string_types = (str,)
+    text_type = str
+else:
+    import __builtin__
+    string_types = (__builtin__.basestring,)
+    text_type = __builtin__.unicode
+
+
+def import_boto3():
+    ''' Returns the boto3 module, or None if it isn't installed '''
+
+    try:
+        import boto3
+    except ImportError:
+        return None
+    return boto3
+
+
+def check_startup_budget(refreshed):
+    ''' With EC2_STARTUP_BUDGET set to a number of seconds, fails a run that
+    was answered from the cache (or by the --serve daemon) if it took longer
+    than that, or if it loaded the AWS libraries, so that CI can keep that
+    path fast. Runs that refreshed the cache are not checked. '''
+
+    budget = os.environ.get('EC2_STARTUP_BUDGET')
+    if not budget or refreshed:
+        return
+
+    loaded = sorted(name for name in ('boto', 'boto3', 'botocore') if name in sys.modules)
+    elapsed = time() - SCRIPT_START
+    if loaded:
+        error = "answered from the cache, but imported %s" % ', '.join(loaded)
+    elif elapsed > float(budget):
+        error = "answered from the cache in %.3fs, over the budget of %ss" % (elapsed, budget)
+    else:
+        return
+    sys.stderr.write('ERROR: "%s", while: checking EC2_STARTUP_BUDGET' % error)
+    sys.exit(1)
+
+
+# Set on the threads that run fetches concurrently, see pool_task
+pool_threads = threading.local()
+
+
+def on_pool_thread():
+    ''' Returns whether the current thread runs a fetch for run_fetches or
+    map_concurrently, or was started by one '''
+
+    return getattr(pool_threads, 'active', False)
+
+
+def pool_task(func, active=True):
+    ''' Returns func wrapped to run with the current thread marked as a pool
+    thread if active. Concurrent fetches only start pools of their own on
+    unmarked threads, so that they don't multiply max_workers. '''
+
+    def task(*args):
+        was_active = on_pool_thread()
+        pool_threads.active = active
+        try:
+            return func(*args)
+        finally:
+            pool_threads.active = was_active
+    return task
+
+
+def prefetch(iterable, depth=1):
+    ''' Iterates over iterable in a background thread, staying at most depth
+    items ahead of the consumer. Exceptions raised while iterating are
+    re-raised in the consumer. '''
+
+    items = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except BaseException as e:
+            items.put((done, e))
+        else:
+            items.put((done, None))
+
+    def consume():
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+
+    # Start producing straight away, not on the first call to next()
+    producer = threading.Thread(target=pool_task(produce, on_pool_thread()))
+    producer.daemon = True
+    producer.start()
+
+    return consume()
+
+
+class AccountFetchTimeout(Exception):
+    ''' Raised for a fetch of an account that is still running at the
+    account's fetch_timeout '''
+    pass
+
+
+class Boto3Object(object):
+    ''' Plain attribute holder used to mimic the small boto helper objects
+    (placements, states, security groups, ...) '''
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+
+class Boto3Reservation(object):
+    ''' A reservation from boto3's describe_instances, shaped like a
+    boto.ec2.instance.Reservation '''
+
+    def __init__(self, reservation, region):
+        self.id = reservation.get('ReservationId')
+        self.owner_id = reservation.get('OwnerId')
+        self.instances = [Boto3Instance(i, region) for i in reservation.get('Instances', [])]
+
+
+class Boto3Instance(object):
+    ''' An instance from boto3's describe_instances, exposing the same
+    attributes as a boto.ec2.instance.Instance so that add_instance and
+    get_host_info_dict_from_instance work on either. '''
+
+    def __init__(self, instance, region):
+        placement = instance.get('Placement', {})
+        self.region = Boto3Object(name=region)
+        self.id = instance.get('InstanceId')
+        self.image_id = instance.get('ImageId')
+        self.dns_name = instance.get('PublicDnsName')
+        self.public_dns_name = instance.get('PublicDnsName')
+        self.private_dns_name = instance.get('PrivateDnsName')
+        self.key_name = instance.get('KeyName')
+        self.instance_type = instance.get('InstanceType')
+        self.launch_time = self._format_time(instance.get('LaunchTime'))
+        self.kernel = instance.get('KernelId')
+        self.ramdisk = instance.get('RamdiskId')
+        self.product_codes = [p.get('ProductCodeId') for p in instance.get('ProductCodes', [])]
+        self.ami_launch_index = self._format_value(instance.get('AmiLaunchIndex'))
+        self.monitoring_state = instance.get('Monitoring', {}).get('State')
+        self.monitored = self.monitoring_state == 'enabled'
+        self.spot_instance_request_id = instance.get('SpotInstanceRequestId')
+        self.subnet_id = instance.get('SubnetId')
+        self.vpc_id = instance.get('VpcId')
+        self.private_ip_address = instance.get('PrivateIpAddress')
+        self.ip_address = instance.get('PublicIpAddress')
+        self.requester_id = None
+        self._in_monitoring_element = False
+        self.persistent = False
+        self.root_device_name = instance.get('RootDeviceName')
+        self.root_device_type = instance.get('RootDeviceType')
+        self.block_device_mapping = dict(
+            (b['DeviceName'], Boto3Object(volume_id=b.get('Ebs', {}).get('VolumeId')))
+            for b in instance.get('BlockDeviceMappings', []))
+        self.state_reason = None
+        if instance.get('StateReason'):
+            self.state_reason = {'code': instance['StateReason'].get('Code'),
+                                 'message': instance['StateReason'].get('Message')}
+        self.group_name = None
+        self.client_token = instance.get('ClientToken') or None
+        self.eventsSet = None
+        self.groups = [Boto3Object(id=g.get('GroupId'), name=g.get('GroupName'))
+                       for g in instance.get('SecurityGroups', [])]
+        self.platform = instance.get('Platform')
+        self.interfaces = [n.get('NetworkInterfaceId') for n in instance.get('NetworkInterfaces', [])]
+        self.hypervisor = instance.get('Hypervisor')
+        self.virtualization_type = instance.get('VirtualizationType')
+        self.architecture = instance.get('Architecture')
+        self.instance_profile = None
+        if instance.get('IamInstanceProfile'):
+            self.instance_profile = {'arn': instance['IamInstanceProfile'].get('Arn'),
+                                     'id': instance['IamInstanceProfile'].get('Id')}
+        self.ebs_optimized = instance.get('EbsOptimized', False)
+        self.tags = dict((t['Key'], t['Value']) for t in instance.get('Tags', []))
+
+        # boto keeps the elements of the response it has no attribute for as
+        # their raw text, under their own (camelCase) name
+        self.reason = instance.get('StateTransitionReason') or ''
+        self.monitoring = ''
+        self.item = ''
+        if 'SourceDestCheck' in instance:
+            self.sourceDestCheck = self._format_value(instance['SourceDestCheck'])
+
+        self._previous_state = None
+        self._state = Boto3Object(code=instance.get('State', {}).get('Code'),
+                                  name=instance.get('State', {}).get('Name'))
+        self._placement = Boto3Object(zone=placement.get('AvailabilityZone'),
+                                      group_name=placement.get('GroupName'),
+                                      tenancy=placement.get('Tenancy'))
+
+    @staticmethod
+    def _format_time(value):
+        ''' boto returns timestamps as the raw ISO 8601 string from the API '''
+        if value is None or isinstance(value, string_types):
+            return value
+        return value.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    @staticmethod
+    def _format_value(value):
+        ''' boto returns numbers and booleans it has no attribute for as the
+        raw text from the API too, e.g. 'true' '''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if value is None:
+            return None
+        return text_type(value)
+
+    @property
+    def state(self):
+        return self._state.name
+
+    @property
+    def state_code(self):
+        return self._state.code
+
+    @property
+    def previous_state(self):
+        if self._previous_state:
+            return self._previous_state.name
+        return None
+
+    @property
+    def previous_state_code(self):
+        if self._previous_state:
+            return self._previous_state.code
+        return 0
+
+    @property
+    def placement(self):
+        return self._placement.zone
+
+
+class CacheBackendError(Exception):
+    ''' Raised when a cache backend can't be reached or used '''
+    pass
+
+
+class CacheBackend(object):
+    ''' Where the inventory cache is kept. Entries are bytes stored under a
+    short key ('cache', 'index', ...); publish() makes several entries
+    visible together, and an entry published with a ttl disappears ttl
+    seconds later. '''
+
+    # A crashed refresh can't hold the lock of a shared backend longer than this
+    lock_lease = 600
+
+    # Whether try_lock can ever succeed
+    can_lock = True
+
+    def get(self, key):
+        ''' Returns the bytes stored under key, or None '''
+        raise NotImplementedError
+
+    def open(self, key):
+        ''' Returns a binary file object reading the entry, or None '''
+        data = self.get(key)
+        if data is None:
+            return None
+        return io.BytesIO(data)
+
+    def age(self, key):
+        ''' Returns the seconds since key was published, or None if it is
+        missing or has expired '''
+        raise NotImplementedError
+
+    def publish(self, entries, published=None):
+        ''' Stores a list of (key, data, ttl) entries, all or none. data is
+        bytes, or a binary file object to read them from. ttl may be None for
+        entries that never expire. The entries are dated now, or published
+        (a time() value) if given; their ttl counts from that date. '''
+        raise NotImplementedError
+
+    @staticmethod
+    def read_entry(data):
+        ''' Returns the bytes of the data of an entry given to publish '''
+        if hasattr(data, 'read'):
+            return data.read()
+        return data
+
+    def try_lock(self):
+        ''' Takes the refresh lock if it is free, and returns whether it did '''
+        raise NotImplementedError
+
+    def unlock(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, timeout):
+        ''' Holds the refresh lock for the duration of the block. Waits up to
+        timeout seconds for it, and yields whether it was acquired; the block
+        runs either way, so a stuck lock holder can only delay other
+        processes, not stop them. '''
+
+        if not self.can_lock:
+            yield False
+            return
+
+        deadline = time() + timeout
+        locked = self.try_lock()
+        while not locked and time() < deadline:
+            time_module.sleep(0.1)
+            locked = self.try_lock()
+
+        try:
+            yield locked
+        finally:
+            if locked:
+                self.unlock()
+
+
+class FileCacheBackend(CacheBackend):
+    ''' Keeps every entry in its own file, <cache_dir>/<name>.<key>. Entries
+    are written to temporary files and renamed into place in the order they
+    were given, and the lock is an flock on <name>.lock. '''
+
+    can_lock = HAS_FCNTL
+
+    def __init__(self, cache_dir, name):
+        self.cache_dir = cache_dir
+        self.name = name
+        self.lock_file = None
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "%s.%s" % (self.name, key))
+
+    def ttls(self):
+        try:
+            with open(self.path('ttl'), 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def age(self, key):
+        try:
+            age = time() - os.path.getmtime(self.path(key))
+        except OSError:
+            return None
+        ttl = self.ttls().get(key)
+        if ttl is not None and age > ttl:
+            return None
+        return age
+
+    def get(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def open(self, key):
+        if self.age(key) is None:
+            return None
+        try:
+            return open(self.path(key), 'rb')
+        except IOError:
+            return None
+
+    def publish(self, entries, published=None):
+        ttls = self.ttls()
+        staged = []
+        for key, data, ttl in entries:
+            ttls[key] = ttl
+            tmp_path = self.stage(key, data)
+            if published is not None:
+                os.utime(tmp_path, (published, published))
+            staged.append((tmp_path, self.path(key)))
+        staged.insert(0, (self.stage('ttl', json.dumps(ttls).encode('utf-8')), self.path('ttl')))
+        for tmp_path, path in staged:
+            os.rename(tmp_path, path)
+
+    def stage(self, key, data):
+        tmp_path = '%s.%d.tmp' % (self.path(key), os.getpid())
+        with open(tmp_path, 'wb') as f:
+            if hasattr(data, 'read'):
+                shutil.copyfileobj(data, f, COPY_BUFFER_SIZE)
+            else:
+                f.write(data)
+        return tmp_path
+
+    def try_lock(self):
+        lock_file = open(self.path('lock'), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def unlock(self):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+
+
+class SqliteCacheBackend(CacheBackend):
+    ''' Keeps the entries of every cache namespace in one SQLite database,
+    which can live on a volume shared by several containers '''
+
+    def __init__(self, path, name):
+        if not HAS_SQLITE:
+            raise CacheBackendError("the sqlite cache backend requires the sqlite3 module")
+        self.path = path
+        self.name = name
+        self.lock_owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), random.random())
+        with self.connect(write=True) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS cache_entries (namespace TEXT, key TEXT, value BLOB,'
+                       ' published REAL, expires REAL, PRIMARY KEY (namespace, key))')
+            db.execute('CREATE TABLE IF NOT EXISTS cache_locks (namespace TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    @contextmanager
+    def connect(self, write=False):
+        ''' Yields a connection inside a transaction, which is committed if
+        the block completes and rolled back otherwise '''
+        db = None
+        try:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            yield db
+            db.execute('COMMIT')
+        except sqlite3.Error as e:
+            raise CacheBackendError("can't use the cache database %s: %s" % (self.path, e))
+        finally:
+            if db is not None:
+                db.close()
+
+    def row(self, key):
+        with self.connect() as db:
+            return db.execute('SELECT value, published FROM cache_entries WHERE namespace = ? AND key = ?'
+                              ' AND (expires IS NULL OR expires > ?)', (self.name, key, time())).fetchone()
+
+    def get(self, key):
+        row = self.row(key)
+        return bytes(row[0]) if row else None
+
+    def age(self, key):
+        row = self.row(key)
+        return time() - row[1] if row else None
+
+    def publish(self, entries, published=None):
+        now = time()
+        if published is None:
+            published = now
+        with self.connect(write=True) as db:
+            db.execute('DELETE FROM cache_entries WHERE expires <= ?', (now,))
+            db.executemany('INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?)',
+                           [(self.name, key, sqlite3.Binary(self.read_entry(data)), published,
+                             published + ttl if ttl is not None else None)
+                            for key, data, ttl in entries])
+
+    def try_lock(self):
+        now = time()
+        with self.connect(write=True) as db:
+            db.execute('DELETE FROM cache_locks WHERE namespace = ? AND expires <= ?', (self.name, now))
+            db.execute('INSERT OR IGNORE INTO cache_locks VALUES (?, ?, ?)',
+                       (self.name, self.lock_owner, now + self.lock_lease))
+            owner = db.execute('SELECT owner FROM cache_locks WHERE namespace = ?', (self.name,)).fetchone()
+        return owner is not None and owner[0] == self.lock_owner
+
+    def unlock(self):
+        with self.connect(write=True) as db:
+            db.execute('DELETE FROM cache_locks WHERE namespace = ? AND owner = ?', (self.name, self.lock_owner))
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection(object):
+    ''' Just enough of the Redis protocol (RESP) to run simple commands,
+    so the redis backend has no dependencies '''
+
+    def __init__(self, host, port, db=0, password=None, timeout=10):
+        self.address = (host, port)
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        try:
+            self.sock = socket.create_connection(self.address, self.timeout)
+        except (socket.error, socket.timeout) as e:
+            raise CacheBackendError("can't connect to Redis at %s:%d: %s" % (self.address + (e,)))
+        self.reader = self.sock.makefile('rb')
+        if self.password:
+            self.read_replies(self.send([('AUTH', self.password)]))
+        if self.db:
+            self.read_replies(self.send([('SELECT', self.db)]))
+
+    def execute(self, *args):
+        return self.pipeline([args])[0]
+
+    def pipeline(self, commands):
+        ''' Sends several commands at once and returns their replies '''
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.connect()
+                return self.read_replies(self.send(commands))
+            except (socket.error, socket.timeout, IOError) as e:
+                self.sock = None
+                raise CacheBackendError("lost connection to Redis at %s:%d: %s" % (self.address + (e,)))
+
+    def send(self, commands):
+        buf = []
+        for args in commands:
+            buf.append(('*%d\r\n' % len(args)).encode('ascii'))
+            for arg in args:
+                if not isinstance(arg, bytes):
+                    arg = text_type(arg).encode('utf-8')
+                buf.append(('$%d\r\n' % len(arg)).encode('ascii'))
+                buf.append(arg)
+                buf.append(b'\r\n')
+        self.sock.sendall(b''.join(buf))
+        return len(commands)
+
+    def read_replies(self, count):
+        replies = [self.read_reply() for i in range(count)]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise CacheBackendError("Redis error: %s" % reply)
+        return replies
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise IOError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            return RedisError(rest.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            if int(rest) < 0:
+                return None
+            return self.reader.read(int(rest) + 2)[:-2]
+        if kind == b'*':
+            if int(rest) < 0:
+                return None
+            return [self.read_reply() for i in range(int(rest))]
+        raise IOError("unexpected reply from Redis: %r" % line)
+
+
+class RedisCacheBackend(CacheBackend):
+    ''' Keeps the entries in Redis (or anything that speaks its protocol),
+    so that every machine pointing at the same server shares one cache.
+    Entries are stored under <name>:<key>, with their publish time under
+    <name>:<key>:published. '''
+
+    def __init__(self, url, name, timeout=10):
+        try:
+            from urllib.parse import urlparse
+        except ImportError:
+            from urlparse import urlparse
+        url = urlparse(url)
+        if url.scheme != 'redis':
+            raise CacheBackendError("cache_redis_url must look like redis://[:password@]host[:port][/db]")
+        db = int(url.path.lstrip('/') or 0)
+        self.redis = RedisConnection(url.hostname or 'localhost', url.port or 6379, db, url.password, timeout)
+        self.name = name
+        self.lock_token = '%s:%d:%s' % (socket.gethostname(), os.getpid(), random.random())
+
+    def key(self, key):
+        return '%s:%s' % (self.name, key)
+
+    def get(self, key):
+        return self.redis.execute('GET', self.key(key))
+
+    def age(self, key):
+        published = self.redis.execute('GET', self.key(key) + ':published')
+        if published is None:
+            return None
+        return time() - float(published)
+
+    def publish(self, entries, published=None):
+        now = time()
+        if published is None:
+            published = now
+        commands = [('MULTI',)]
+        for key, data, ttl in entries:
+            # PX is relative, so only what is left of ttl
+            expiry = ('PX', max(1, int((published + ttl - now) * 1000))) if ttl is not None else ()
+            commands.append(('SET', self.key(key), self.read_entry(data)) + expiry)
+            commands.append(('SET', self.key(key) + ':published', repr(published)) + expiry)
+        commands.append(('EXEC',))
+        self.redis.pipeline(commands)
+
+    def try_lock(self):
+        return self.redis.execute('SET', self.key('lock'), self.lock_token,
+                                  'NX', 'PX', self.lock_lease * 1000) is not None
+
+    def unlock(self):
+        if self.redis.execute('GET', self.key('lock')) == self.lock_token.encode('utf-8'):
+            self.redis.execute('DEL', self.key('lock'))
+
+
+class GroupChildren(list):
+    ''' The children of a group. It is a list, so it serializes like one,
+    but it also keeps a set of its items, so that adding a child doesn't
+    have to scan every child already there. '''
+
+    def __init__(self, children=()):
+        list.__init__(self, children)
+        self.members = set(self)
+
+    def add(self, child):
+        if child not in self.members:
+            self.members.add(child)
+            self.append(child)
+
+
+# First bytes of a gzip file, used to recognise compressed cache files
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Chunk size when copying the cache to stdout
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Characters to_safe replaces, depending on replace_dash_in_groups
+UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_]')
+UNSAFE_CHARS_KEEP_DASH = re.compile(r'[^A-Za-z0-9_\-]')
+
+# Word boundaries in CamelCase keys, see uncammelize
+CAMEL_WORD = re.compile('(.)([A-Z][a-z]+)')
+CAMEL_HUMP = re.compile('([a-z0-9])([A-Z])')
+
+# Most results a memoized function keeps before starting over
+MEMO_SIZE = 65536
+
+
+def memoize(func):
+    ''' Caches the results of func, a pure function of hashable arguments.
+    The cache is emptied when it reaches MEMO_SIZE entries, which bounds the
+    memory used by a long-running --serve daemon. '''
+
+    results = {}
+
+    def memoized(*args):
+        try:
+            return results[args]
+        except KeyError:
+            pass
+        if len(results) >= MEMO_SIZE:
+            results.clear()
+        result = results[args] = func(*args)
+        return result
+    return memoized
+
+
+@memoize
+def to_safe(word, replace_dash):
+    if replace_dash:
+        return UNSAFE_CHARS.sub('_', word)
+    return UNSAFE_CHARS_KEEP_DASH.sub('_', word)
+
+
+@memoize
+def uncammelize(key):
+    return CAMEL_HUMP.sub(r'\1_\2', CAMEL_WORD.sub(r'\1_\2', key)).lower()
+
+
+def project_scalar(host_info, key, value):
+    ''' Stores value under key in host_info if it is a boolean, an integer,
+    a string (stripped) or None (as an empty string), unless key is None.
+    Returns False, storing nothing, for any other type. '''
+
+    value_type = type(value)
+    if value_type is int or value_type is bool:
+        pass
+    elif isinstance(value, string_types):
+        value = value.strip()
+    elif value is None:
+        value = ''
+    else:
+        return False
+    if key is not None:
+        host_info[key] = value
+    return True
+
+
+def compile_name_patterns(patterns):
+    ''' Compiles a comma-separated list of globs, or of regular expressions
+    prefixed with 're:', into a list of regular expressions that match a
+    whole name '''
+
+    compiled = []
+    for pattern in patterns.split(','):
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        if pattern.startswith('re:'):
+            compiled.append(re.compile('(?:%s)$' % pattern[3:]))
+        else:
+            compiled.append(re.compile(fnmatch.translate(pattern)))
+    return compiled
+
+
+# Separator between the items of pretty-printed JSON, as json.dumps writes it
+# with indent set
+PRETTY_ITEM_SEPARATOR = ',' if PY3 else ', '
+
+# Most items of a dict iter_json encodes at once
+JSON_BATCH_SIZE = 128
+
+
+@memoize
+def import_orjson():
+    ''' Returns the orjson module, or None if it isn't installed '''
+
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def dumps_json(data, pretty=False, level=0):
+    ''' Returns data as JSON text, as json.dumps(data, sort_keys=True) writes
+    it with indent=2 if pretty, or without spaces otherwise. Pretty text is
+    indented as if it were nested level deep. orjson is used when it is
+    installed and writes the same text, i.e. unless data has something
+    orjson can't encode, or characters that json.dumps escapes but orjson
+    doesn't (non-ASCII and DEL). orjson writes floats in exponent notation
+    differently (1e16 rather than 1e+16), which doesn't change their value. '''
+
+    text = None
+    orjson = import_orjson()
+    if orjson is not None:
+        try:
+            text = orjson.dumps(data, option=orjson.OPT_SORT_KEYS | (orjson.OPT_INDENT_2 if pretty else 0))
+        except TypeError:
+            pass
+        else:
+            text = text.decode('ascii') if text.isascii() and b'\x7f' not in text else None
+    if text is None:
+        if pretty:
+            text = json.dumps(data, sort_keys=True, indent=2)
+        else:
+            text = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    if pretty and level:
+        # JSON strings can't hold a raw newline, so every newline is
+        # followed by an indentation
+        text = text.replace('\n', '\n' + '  ' * level)
+    return text
+
+
+def iter_json(data, pretty=False, expand=None, level=0):
+    ''' Yields the text of dumps_json(data, pretty, level) in chunks of up
+    to JSON_BATCH_SIZE items of the dict data, so that a large dict can be
+    written out without ever being held as a single string. expand maps the
+    keys whose values are themselves written this way to their own expand,
+    e.g. {'_meta': {'hostvars': {}}}. '''
+
+    if expand is None or not isinstance(data, dict) or not data:
+        yield dumps_json(data, pretty, level)
+        return
+
+    if pretty:
+        newline = '\n' + '  ' * (level + 1)
+        item_separator = PRETTY_ITEM_SEPARATOR + newline
+        key_separator = ': '
+        end = '\n' + '  ' * level + '}'
+    else:
+        newline, item_separator, key_separator, end = '', ',', ':', '}'
+
+    separator = '{' + newline
+    batch = {}
+    for key in sorted(data) + [None]:
+        if batch and (key is None or key in expand or len(batch) == JSON_BATCH_SIZE):
+            # The items of the batch, without the braces around them
+            yield separator + dumps_json(batch, pretty, level)[len(newline) + 1:-len(end)]
+            separator = item_separator
+            batch = {}
+        if key is None:
+            break
+        if key in expand:
+            yield separator + json.dumps(key) + key_separator
+            for chunk in iter_json(data[key], pretty, expand[key], level + 1):
+                yield chunk
+            separator = item_separator
+        else:
+            batch[key] = data[key]
+    yield end
+
+
+def get_group_hosts(inventory):
+    ''' Returns the hosts each group of inventory applies to, as a set: its
+    own hosts and, recursively, those of its child groups '''
+
+    hosts = {}
+    children = {}
+    for name, group in inventory.items():
+        if name == '_meta':
+            continue
+        if isinstance(group, dict):
+            hosts[name] = set(group.get('hosts') or ())
+            children[name] = group.get('children') or ()
+        else:
+            hosts[name] = set(group)
+
+    def resolve(name, parents):
+        parents = parents | set([name])
+        for child in children.pop(name, ()):
+            if child in hosts and child not in parents:
+                hosts[name] |= resolve(child, parents)
+        return hosts[name]
+
+    for name in list(children):
+        resolve(name, frozenset())
+    return hosts
+
+
+def hoist_group_vars(inventory):
+    ''' Returns a copy of inventory in which each hostvar that has the same
+    value (and type) for every host a group applies to is set once, in
+    the vars of the group, instead of on each of those hosts. Ansible
+    resolves the same variables for every host: every group a hostvar is
+    moved to has the value the host had. Groups are tried largest first,
+    and a hostvar is only moved to a group when that removes it from at
+    least two hosts that a larger group doesn't already cover. '''
+
+    hostvars = inventory['_meta']['hostvars']
+    group_hosts = get_group_hosts(inventory)
+
+    group_vars = {}
+    removed = {}
+    missing = object()
+    for name in sorted(group_hosts, key=lambda name: (-len(group_hosts[name]), name)):
+        hosts = group_hosts[name]
+        if len(hosts) < 2:
+            continue
+        members = [hostvars.get(host) for host in hosts]
+        if None in members:
+            # A host without hostvars would get the group vars as new ones
+            continue
+
+        for key, value in members[0].items():
+            # Most variables that differ do so between any two hosts (IDs,
+            # addresses...), so try two before all of them
+            if members[1].get(key, missing) != value or members[-1].get(key, missing) != value:
+                continue
+            covered = removed.get(key, ())
+            if len(covered) == len(hostvars):
+                # Already removed from every host
+                continue
+            gained = hosts.difference(covered)
+            if len(gained) < 2:
+                continue
+            values = [host_vars.get(key, missing) for host_vars in members]
+            if values.count(value) == len(values) and len(set(map(type, values))) == 1:
+                group_vars.setdefault(name, {})[key] = value
+                removed.setdefault(key, set()).update(gained)
+
+    if not group_vars:
+        return inventory
+
+    hoisted = {}
+    for name, group in inventory.items():
+        if name in group_vars:
+            group = dict(group) if isinstance(group, dict) else {'hosts': group}
+            group['vars'] = group_vars[name]
+        hoisted[name] = group
+
+    everywhere = [key for key, hosts in removed.items() if len(hosts) == len(hostvars)]
+    elsewhere = [(key, hosts) for key, hosts in removed.items() if len(hosts) < len(hostvars)]
+    hoisted['_meta'] = dict(inventory['_meta'])
+    hoisted['_meta']['hostvars'] = trimmed = {}
+    for host, host_vars in hostvars.items():
+        keys = everywhere + [key for key, hosts in elsewhere if host in hosts]
+        if keys:
+            host_vars = dict(host_vars)
+            for key in keys:
+                del host_vars[key]
+        trimmed[host] = host_vars
+    return hoisted
+
+
+def unhoist_group_vars(inventory):
+    ''' Undoes hoist_group_vars on inventory, in place: moves the vars of its
+    groups back to the hostvars of the hosts they apply to. Returns
+    inventory. '''
+
+    hoisted = [name for name, group in inventory.items()
+               if name != '_meta' and isinstance(group, dict) and 'vars' in group]
+    if not hoisted:
+        return inventory
+
+    hostvars = inventory['_meta']['hostvars']
+    group_hosts = get_group_hosts(inventory)
+    for name in hoisted:
+        group = inventory[name]
+        for host in group_hosts[name]:
+            host_vars = hostvars.setdefault(host, {})
+            for key, value in group['vars'].items():
+                host_vars.setdefault(key, value)
+        del group['vars']
+        if list(group) == ['hosts']:
+            # Was a plain list of hosts, see push
+            inventory[name] = group['hosts']
+    return inventory
+
+
+def build_arg_parser():
+    ''' Command line arguments of the script '''
+
+    parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on EC2')
+    parser.add_argument('--list', action='store_true', default=True,
+                       help='List instances (default: True)')
+    parser.add_argument('--host', action='store',
+                       help='Get all the variables about a specific instance')
+    parser.add_argument('--refresh-cache', action='store_true', default=False,
+                       help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+    parser.add_argument('--profile', '--boto-profile', action='store', dest='boto_profile',
+                       help='Use boto profile for connections to EC2')
+    parser.add_argument('--serve', action='store_true', default=False,
+                       help='Keep the inventory in memory and answer other runs of this script over a Unix socket')
+    parser.add_argument('--background-refresh', action='store_true', default=False,
+                       help=argparse.SUPPRESS)
+    return parser
+
+
+def get_ini_path():
+    ''' Returns the path of the ec2.ini file in use '''
+
+    scriptbasename = __file__
+    scriptbasename = os.path.basename(scriptbasename)
+    scriptbasename = scriptbasename.replace('.py', '')
+
+    defaults = {'ec2': {
+        'ini_path': os.path.join(os.path.dirname(__file__), '%s.ini' % scriptbasename)
+        }
+    }
+
+    ec2_ini_path = os.environ.get('EC2_INI_PATH', defaults['ec2']['ini_path'])
+    return os.path.abspath(os.path.expanduser(os.path.expandvars(ec2_ini_path)))
+
+
+def read_ini(ec2_ini_path):
+    if PY3:
+        config = configparser.ConfigParser()
+    else:
+        config = configparser.SafeConfigParser()
+    config.read(ec2_ini_path)
+    return config
+
+
+def get_daemon_identity(ec2_ini_path, boto_profile):
+    ''' What a daemon and its clients must agree on for the daemon's
+    inventory to be the one the client would have built '''
+
+    try:
+        ini_mtime = os.path.getmtime(ec2_ini_path)
+    except OSError:
+        ini_mtime = None
+    return {'ini': ec2_ini_path, 'ini_mtime': ini_mtime, 'profile': boto_profile or None,
+            'access_key': os.environ.get('AWS_ACCESS_KEY_ID')}
+
+
+def query_inventory_daemon(args, socket_path, identity):
+    ''' Asks the daemon started with --serve on socket_path for what the
+    command line args ask for, and copies its answer to stdout. Returns
+    False if there is no daemon or it can't answer, so the caller can do the
+    work itself. '''
+
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return False
+
+    request = {'identity': identity, 'host': args.host, 'refresh': args.refresh_cache}
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # A forced refresh waits for the daemon to fetch everything
+        sock.settimeout(None if args.refresh_cache else 60)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        reply = sock.makefile('rb')
+        if reply.readline() != b'OK\n':
+            return False
+        data = reply.read()
+    except (socket.error, socket.timeout, IOError):
+        return False
+    finally:
+        sock.close()
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(data)
+    out.flush()
+    return True
+
+
+class InventoryDaemonHandler(socketserver.StreamRequestHandler):
+    ''' Answers one request of query_inventory_daemon '''
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            reply = self.server.inventory.answer_daemon_request(request)
+        except (ValueError, KeyError, AttributeError):
+            reply = None
+        if reply is None:
+            self.wfile.write(b'ERR\n')
+        else:
+            self.wfile.write(b'OK\n' + reply)
+
+
+class InventoryDaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
 
 class Ec2Inventory(object):
 
+    # Most values a single EC2 API filter accepts
+    max_filter_value = 199
+
     def _empty_inventory(self):
         return {"_meta" : {"hostvars" : {}}}
 
@@ -170,74 +1262,272 @@ class Ec2Inventory(object):
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Where to also write the inventory as it is written to the cache, if
+        # it gets refreshed, and whether it was
+        self.inventory_out = None
+        self.inventory_written = False
+
+        # Snapshots of the sources refreshed in this run, to be published with
+        # the inventory, and the state of the adaptive EC2 max age
+        self.source_snapshots = []
+        self.ec2_adaptive_state = None
+
+        # Route53 resource records to domain names, and the names found for
+        # each instance
+        self.route53_records = {}
+        self.route53_names_by_instance = {}
+
         # Boto profile to use (if any)
         self.boto_profile = None
 
         # AWS credentials.
         self.credentials = {}
 
+        # Connections, assumed role credentials and account IDs are kept per
+        # account, see new_account
+        self.default_account = None
+        self.accounts = []
+
+        # Whether this run had to call AWS, see check_startup_budget
+        self.called_aws = False
+
+        # Hostvar names and handlers of instance attributes and API response
+        # keys, see get_instance_projection, and whether each hostvar name
+        # passes hostvars_include and hostvars_exclude
+        self.hostvar_projections = {}
+        self.hostvars_wanted = {}
+
         # Read settings and parse CLI arguments
         self.parse_cli_args()
         self.read_settings()
 
-        # Make sure that profile_name is not passed at all if not set
-        # as pre 2.24 boto will fall over otherwise
-        if self.boto_profile:
-            if not hasattr(boto.ec2.EC2Connection, 'profile_name'):
-                self.fail_with_error("boto version must be >= 2.24 to use profile")
+        try:
+            self.run()
+        except CacheBackendError as e:
+            self.fail_with_error(str(e), 'using the %s cache backend' % self.cache_backend_name)
+
+    def run(self):
+        ''' Refreshes the cache if needed and prints the requested data '''
+
+        if self.args.serve:
+            self.serve()
+            return
+
+        # Let the daemon started with --serve for these settings answer, if
+        # there is one
+        if not self.args.background_refresh and query_inventory_daemon(
+                self.args, self.serve_socket, get_daemon_identity(self.ec2_ini_path, self.boto_profile)):
+            return
 
         # Cache
+        if self.args.background_refresh:
+            # Started by start_background_refresh; nothing to print
+            self.update_cache()
+            return
+        if self.args.list and not self.args.host:
+            # Printed as it is written to the cache, if that is refreshed
+            sys.stdout.flush()
+            self.inventory_out = getattr(sys.stdout, 'buffer', sys.stdout)
+
         if self.args.refresh_cache:
-            self.do_api_calls_update_cache()
+            self.update_cache(force=True)
         elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+            if self.is_cache_valid(self.get_inventory_max_age() + self.cache_stale_while_revalidate):
+                # Serve the expired cache, and refresh it for the next run
+                self.start_background_refresh()
+            else:
+                self.update_cache()
 
         # Data to print
         if self.args.host:
-            data_to_print = self.get_host_info()
+            print(self.get_host_info())
 
         elif self.args.list:
-            # Display list of instances for inventory
-            if self.inventory == self._empty_inventory():
-                data_to_print = self.get_inventory_from_cache()
-            else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+            # Display list of instances for inventory, unless it was already
+            # printed while refreshing the cache
+            if not self.inventory_written:
+                self.print_inventory_from_cache()
 
-        print(data_to_print)
 
+    def is_cache_valid(self, max_age=None):
+        ''' Determines if the cache has expired, or if it is still valid.
+        max_age defaults to the max age of the source that expires first. '''
 
-    def is_cache_valid(self):
-        ''' Determines if the cache files have expired, or if it is still valid '''
+        if max_age is None:
+            max_age = self.get_inventory_max_age()
 
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
-            current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                if os.path.isfile(self.cache_path_index):
-                    return True
+        age = self.cache_backend.age('cache')
+        if age is not None and age < max_age:
+            if self.cache_backend.age('index') is not None:
+                return True
 
         return False
 
 
-    def read_settings(self):
-        ''' Reads the settings from the ec2.ini file '''
-
-        scriptbasename = __file__
-        scriptbasename = os.path.basename(scriptbasename)
-        scriptbasename = scriptbasename.replace('.py', '')
+    def cache_lock(self):
+        ''' Holds the cache backend's refresh lock for the duration of the
+        block, see CacheBackend.lock '''
+
+        return self.cache_backend.lock(self.cache_lock_timeout)
+
+    def start_background_refresh(self):
+        ''' Starts a detached copy of this script that refreshes the cache,
+        unless a refresh is already running or was started by another process
+        whose copy hasn't taken the cache lock yet. The check and the
+        'refresh_started' marker recording the start are done while holding
+        the lock, which is released again for the copy to take. '''
+
+        with self.cache_backend.lock(0) as locked:
+            if self.cache_backend.can_lock and not locked:
+                return
+            # The marker is left to expire, but a cache published since it
+            # was recorded means that refresh is done
+            started = self.cache_backend.age('refresh_started')
+            published = self.cache_backend.age('cache')
+            if started is not None and (published is None or published > started):
+                return
+            # Expires when the copy would have given up waiting for the lock
+            self.cache_backend.publish([('refresh_started', b'', self.cache_lock_timeout)])
+
+            command = [sys.executable, os.path.abspath(__file__), '--background-refresh']
+            if self.args.boto_profile:
+                command.extend(['--profile', self.args.boto_profile])
+
+            import subprocess
+            with open(os.devnull, 'r+') as devnull:
+                subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull,
+                                 close_fds=True, preexec_fn=os.setsid)
+
+    def update_cache(self, force=False):
+        ''' Refreshes the cache, unless another process refreshed it while we
+        were waiting for the cache lock. With force every source is fetched
+        again, regardless of the age of the cache and of its snapshots. '''
+
+        with self.cache_lock() as locked:
+            if locked and not force and self.is_cache_valid():
+                return
+            self.do_api_calls_update_cache(use_snapshots=not force)
+
+    def serve(self):
+        ''' Runs as a daemon: keeps the inventory in memory, refreshes it when
+        the cache expires, and answers query_inventory_daemon on the
+        serve_socket Unix socket '''
+
+        if not hasattr(socket, 'AF_UNIX'):
+            self.fail_with_error("--serve needs Unix domain sockets", "starting the inventory daemon")
+
+        if os.path.exists(self.serve_socket):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.serve_socket)
+                self.fail_with_error("another daemon is listening on %s" % self.serve_socket,
+                                     "starting the inventory daemon")
+            except socket.error:
+                # Left behind by a daemon that is gone
+                os.remove(self.serve_socket)
+            finally:
+                probe.close()
+
+        self.daemon_identity = get_daemon_identity(self.ec2_ini_path, self.boto_profile)
+        self.daemon_state = None
+        self.daemon_refresh_lock = threading.Lock()
+        self.refresh_daemon_state()
+
+        old_umask = os.umask(0o077)
+        try:
+            server = InventoryDaemonServer(self.serve_socket, InventoryDaemonHandler)
+        finally:
+            os.umask(old_umask)
+        server.inventory = self
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
 
-        defaults = {'ec2': {
-            'ini_path': os.path.join(os.path.dirname(__file__), '%s.ini' % scriptbasename)
+        try:
+            refreshed = True
+            while True:
+                max_age = self.get_inventory_max_age()
+                try:
+                    age = self.cache_backend.age('cache') if refreshed else None
+                except CacheBackendError:
+                    age = None
+                # After a failed refresh, wait a full max age before retrying
+                time_module.sleep(max(1, max_age - (age or 0)))
+                refreshed = self.refresh_daemon_state()
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(self.serve_socket)
+
+    def refresh_daemon_state(self, force=False):
+        ''' Brings the daemon's inventory up to date with the cache, which is
+        refreshed first if it has expired. Requests keep being answered from
+        the previous inventory meanwhile. A failed refresh keeps it too, and
+        returns False. '''
+
+        with self.daemon_refresh_lock:
+            self.inventory = self._empty_inventory()
+            self.index = {}
+            self.aws_account_id = None
+            self.inventory_out = io.BytesIO()
+            self.inventory_written = False
+            try:
+                if force or not self.is_cache_valid():
+                    self.update_cache(force=force)
+                if self.inventory_written:
+                    inventory = self.inventory_out.getvalue()
+                else:
+                    # Refreshed by another process, or still valid
+                    inventory_json = self.get_inventory_from_cache()
+                    self.inventory = unhoist_group_vars(json.loads(inventory_json))
+                    self.load_index_from_cache()
+                    inventory = (inventory_json + '\n').encode('utf-8')
+            except (SystemExit, CacheBackendError, IOError, OSError, ValueError) as e:
+                if self.daemon_state is None:
+                    raise
+                sys.stderr.write('ERROR: "%s", while: refreshing the inventory daemon\n' % e)
+                return False
+
+            hostvars = self.inventory['_meta']['hostvars']
+            host_keys = dict((key, hostname) for key, hostname, priority
+                             in reversed(self.get_host_keys(hostvars, self.index)))
+            self.daemon_state = {
+                'inventory': inventory,
+                'hostvars': hostvars,
+                'host_keys': host_keys,
             }
-        }
+            return True
 
-        if six.PY3:
-            config = configparser.ConfigParser()
-        else:
-            config = configparser.SafeConfigParser()
-        ec2_ini_path = os.environ.get('EC2_INI_PATH', defaults['ec2']['ini_path'])
-        ec2_ini_path = os.path.expanduser(os.path.expandvars(ec2_ini_path))
-        config.read(ec2_ini_path)
+    def answer_daemon_request(self, request):
+        ''' Returns the bytes to send back for a request of
+        query_inventory_daemon, or None if the client should work it out
+        itself '''
+
+        if request['identity'] != self.daemon_identity or \
+                get_daemon_identity(self.ec2_ini_path, self.boto_profile) != self.daemon_identity:
+            # Started with other settings or credentials, or the ini file has
+            # changed since
+            return None
+
+        if request['refresh']:
+            self.refresh_daemon_state(force=True)
+
+        state = self.daemon_state
+        if not request['host']:
+            return state['inventory']
+
+        hostname = state['host_keys'].get(request['host'])
+        if hostname is None:
+            # Let the client look the host up in AWS
+            return None
+        return (self.json_format_dict(state['hostvars'][hostname], self.pretty_json) + '\n').encode('utf-8')
+
+    def read_settings(self):
+        ''' Reads the settings from the ec2.ini file '''
+
+        ec2_ini_path = get_ini_path()
+        config = read_ini(ec2_ini_path)
+        self.ec2_ini_path = ec2_ini_path
 
         # is eucalyptus?
         self.eucalyptus_host = None
@@ -247,24 +1537,40 @@ class Ec2Inventory(object):
         if self.eucalyptus and config.has_option('ec2', 'eucalyptus_host'):
             self.eucalyptus_host = config.get('ec2', 'eucalyptus_host')
 
-        # Regions
+        # Regions. With 'all' they are only listed when they are needed, see
+        # get_regions
         self.regions = []
         configRegions = config.get('ec2', 'regions')
+        self.regions_setting = configRegions
         if (configRegions == 'all'):
-            if self.eucalyptus_host:
-                self.regions.append(boto.connect_euca(host=self.eucalyptus_host).region.name, **self.credentials)
-            else:
-                configRegions_exclude = config.get('ec2', 'regions_exclude')
-                for regionInfo in ec2.regions():
-                    if regionInfo.name not in configRegions_exclude:
-                        self.regions.append(regionInfo.name)
+            self.regions = None
+            self.regions_exclude = ''
+            if not self.eucalyptus_host:
+                self.regions_exclude = config.get('ec2', 'regions_exclude')
+                self.regions_setting += ' -' + self.regions_exclude
         else:
             self.regions = configRegions.split(",")
-        if 'auto' in self.regions:
+        if self.regions and 'auto' in self.regions:
             env_region = os.environ.get('AWS_REGION')
             if env_region is None:
                 env_region = os.environ.get('AWS_DEFAULT_REGION')
             self.regions = [ env_region ]
+            self.regions_setting = env_region
+
+        # How long the regions listed for regions = all are cached
+        self.regions_cache_max_age = 86400
+        if config.has_option('ec2', 'regions_cache_max_age'):
+            self.regions_cache_max_age = config.getint('ec2', 'regions_cache_max_age')
+
+        # Don't query regions where the last refresh found nothing, except
+        # once every empty_regions_probe_age seconds
+        self.skip_empty_regions = False
+        if config.has_option('ec2', 'skip_empty_regions'):
+            self.skip_empty_regions = config.getboolean('ec2', 'skip_empty_regions')
+        self.empty_regions_probe_age = 21600
+        if config.has_option('ec2', 'empty_regions_probe_age'):
+            self.empty_regions_probe_age = config.getint('ec2', 'empty_regions_probe_age')
+        self.regions_state = None
 
         # Destination addresses
         self.destination_variable = config.get('ec2', 'destination_variable')
@@ -293,6 +1599,12 @@ class Ec2Inventory(object):
         if config.has_option('ec2', 'route53_excluded_zones'):
             self.route53_excluded_zones.extend(
                 config.get('ec2', 'route53_excluded_zones', '').split(','))
+        # Route53 records change far less often than instances, so they are
+        # cached per zone with their own max age (default: cache_max_age)
+        if config.has_option('ec2', 'route53_cache_max_age'):
+            self.route53_cache_max_age = config.getint('ec2', 'route53_cache_max_age')
+        else:
+            self.route53_cache_max_age = config.getint('ec2', 'cache_max_age')
 
         # Include RDS instances?
         self.rds_enabled = True
@@ -396,15 +1708,96 @@ class Ec2Inventory(object):
             cache_dir = os.path.join(cache_dir, 'profile_' + self.boto_profile)
         if not os.path.exists(cache_dir):
             os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
 
+        # The cache file names are completed by set_cache_paths once every
+        # setting has been read
         cache_name = 'ansible-ec2'
         cache_id = self.boto_profile or os.environ.get('AWS_ACCESS_KEY_ID', self.credentials.get('aws_access_key_id'))
         if cache_id:
             cache_name = '%s-%s' % (cache_name, cache_id)
-        self.cache_path_cache = os.path.join(cache_dir, "%s.cache" % cache_name)
-        self.cache_path_index = os.path.join(cache_dir, "%s.index" % cache_name)
+        self.cache_name = cache_name
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
 
+        # Max age of each source's snapshot (default: cache_max_age), so that
+        # slow-changing sources aren't fetched as often as instances. The
+        # inventory is rebuilt when the first of them expires, from the
+        # snapshots of the sources that haven't.
+        for source in ('ec2', 'rds', 'elasticache'):
+            option = '%s_cache_max_age' % source
+            if config.has_option('ec2', option):
+                setattr(self, option, config.getint('ec2', option))
+            else:
+                setattr(self, option, self.cache_max_age)
+
+        # Adapt the EC2 max age to how much the instances change: it doubles
+        # after refreshes that find nothing changed and halves when they keep
+        # finding changes, staying between the min and max ages below
+        self.ec2_cache_adaptive = False
+        if config.has_option('ec2', 'ec2_cache_adaptive'):
+            self.ec2_cache_adaptive = config.getboolean('ec2', 'ec2_cache_adaptive')
+        self.ec2_cache_adaptive_min_age = max(1, self.ec2_cache_max_age // 4)
+        if config.has_option('ec2', 'ec2_cache_adaptive_min_age'):
+            self.ec2_cache_adaptive_min_age = config.getint('ec2', 'ec2_cache_adaptive_min_age')
+        self.ec2_cache_adaptive_max_age = self.ec2_cache_max_age * 4
+        if config.has_option('ec2', 'ec2_cache_adaptive_max_age'):
+            self.ec2_cache_adaptive_max_age = config.getint('ec2', 'ec2_cache_adaptive_max_age')
+
+        # Format of the JSON printed and cached: 'pretty' (sorted and indented)
+        # or 'compact'
+        self.pretty_json = True
+        if config.has_option('ec2', 'json_format'):
+            json_format = config.get('ec2', 'json_format')
+            if json_format not in ('pretty', 'compact'):
+                self.fail_with_error("json_format must be either 'pretty' or 'compact'", "reading settings")
+            self.pretty_json = json_format == 'pretty'
+
+        # Write the hostvars that every host of a group shares once, as vars
+        # of the group, see hoist_group_vars
+        self.hoist_group_vars = False
+        if config.has_option('ec2', 'hoist_group_vars'):
+            self.hoist_group_vars = config.getboolean('ec2', 'hoist_group_vars')
+
+        # Compression of the cache files: 'none' or 'gzip'
+        self.cache_compression = 'none'
+        if config.has_option('ec2', 'cache_compression'):
+            self.cache_compression = config.get('ec2', 'cache_compression')
+        if self.cache_compression not in ('none', 'gzip'):
+            self.fail_with_error("cache_compression must be either 'none' or 'gzip'", "reading settings")
+
+        # Seconds past cache_max_age during which an expired cache is still
+        # served, while a background process refreshes it. Older caches are
+        # refreshed before answering, as usual.
+        self.cache_stale_while_revalidate = 0
+        if config.has_option('ec2', 'cache_stale_while_revalidate'):
+            self.cache_stale_while_revalidate = config.getint('ec2', 'cache_stale_while_revalidate')
+
+        # Unix socket of the --serve daemon (default: named like the cache
+        # files, see set_cache_paths)
+        self.serve_socket = None
+        if config.has_option('ec2', 'serve_socket'):
+            self.serve_socket = os.path.expanduser(config.get('ec2', 'serve_socket'))
+
+        # Seconds to wait for another process refreshing the cache
+        self.cache_lock_timeout = 120
+        if config.has_option('ec2', 'cache_lock_timeout'):
+            self.cache_lock_timeout = config.getint('ec2', 'cache_lock_timeout')
+
+        # Where the cache is kept: 'file' (in cache_path), 'sqlite' (in the
+        # database at cache_sqlite_path) or 'redis' (on the server at
+        # cache_redis_url, shared by every machine pointing at it)
+        self.cache_backend_name = 'file'
+        if config.has_option('ec2', 'cache_backend'):
+            self.cache_backend_name = config.get('ec2', 'cache_backend')
+        if self.cache_backend_name not in ('file', 'sqlite', 'redis'):
+            self.fail_with_error("cache_backend must be one of 'file', 'sqlite' or 'redis'", "reading settings")
+        self.cache_sqlite_path = os.path.join(cache_dir, 'ansible-ec2.sqlite')
+        if config.has_option('ec2', 'cache_sqlite_path'):
+            self.cache_sqlite_path = os.path.expanduser(config.get('ec2', 'cache_sqlite_path'))
+        self.cache_redis_url = 'redis://localhost:6379/0'
+        if config.has_option('ec2', 'cache_redis_url'):
+            self.cache_redis_url = config.get('ec2', 'cache_redis_url')
+
         if config.has_option('ec2', 'expand_csv_tags'):
             self.expand_csv_tags = config.getboolean('ec2', 'expand_csv_tags')
         else:
@@ -428,6 +1821,50 @@ class Ec2Inventory(object):
         else:
             self.iam_role = None
 
+        # Keep the assumed role's credentials in the cache directory, so
+        # consecutive runs don't call sts:AssumeRole again. They are renewed
+        # iam_role_credentials_margin seconds before they expire.
+        self.cache_iam_role_credentials = True
+        if config.has_option('ec2', 'cache_iam_role_credentials'):
+            self.cache_iam_role_credentials = config.getboolean('ec2', 'cache_iam_role_credentials')
+        self.iam_role_credentials_margin = 300
+        if config.has_option('ec2', 'iam_role_credentials_margin'):
+            self.iam_role_credentials_margin = config.getint('ec2', 'iam_role_credentials_margin')
+
+        # Library used to fetch EC2 instances: 'boto' fetches every reservation
+        # of a region before adding any of them, 'boto3' streams the instances
+        # page by page through describe_instances paginators.
+        self.instance_fetch_backend = 'boto'
+        if config.has_option('ec2', 'instance_fetch_backend'):
+            self.instance_fetch_backend = config.get('ec2', 'instance_fetch_backend')
+        if self.instance_fetch_backend not in ('boto', 'boto3'):
+            self.fail_with_error("instance_fetch_backend must be either 'boto' or 'boto3'", "reading settings")
+        if self.instance_fetch_backend == 'boto3':
+            if self.eucalyptus:
+                self.fail_with_error("instance_fetch_backend = boto3 is not supported with Eucalyptus", "reading settings")
+
+        # How instance tags are resolved after describing instances:
+        #  - full: fetch every instance's tags again (the tags in the describe
+        #    response are not guaranteed to be complete)
+        #  - verify_sample: only re-fetch tags for instances described without
+        #    tags, plus tag_verify_sample_size random others; if any of those
+        #    disagree, fall back to full
+        #  - trust_describe: use the tags from the describe response as they are
+        self.tag_resolution = 'full'
+        if config.has_option('ec2', 'tag_resolution'):
+            self.tag_resolution = config.get('ec2', 'tag_resolution')
+        if self.tag_resolution not in ('full', 'verify_sample', 'trust_describe'):
+            self.fail_with_error("tag_resolution must be one of 'full', 'verify_sample' or 'trust_describe'",
+                                 "reading settings")
+        self.tag_verify_sample_size = 10
+        if config.has_option('ec2', 'tag_verify_sample_size'):
+            self.tag_verify_sample_size = config.getint('ec2', 'tag_verify_sample_size')
+
+        # Number of AWS API calls (regions and services) to run concurrently
+        self.max_workers = 1
+        if config.has_option('ec2', 'max_workers'):
+            self.max_workers = config.getint('ec2', 'max_workers')
+
         # Configure which groups should be created.
         group_by_options = [
             'group_by_instance_id',
@@ -476,6 +1913,15 @@ class Ec2Inventory(object):
         except configparser.NoOptionError:
             self.pattern_exclude = None
 
+        # Only build the hostvars that match hostvars_include (if set) and
+        # don't match hostvars_exclude. ansible_ssh_host is always kept.
+        for option in ['hostvars_include', 'hostvars_exclude']:
+            if config.has_option('ec2', option):
+                setattr(self, option, compile_name_patterns(config.get('ec2', option)))
+            else:
+                setattr(self, option, [])
+        self.filter_hostvars = bool(self.hostvars_include or self.hostvars_exclude)
+
         # Do we want to stack multiple filters?
         if config.has_option('ec2', 'stack_filters'):
             self.stack_filters = config.getboolean('ec2', 'stack_filters')
@@ -485,82 +1931,745 @@ class Ec2Inventory(object):
         # Instance filters (see boto and EC2 API docs). Ignore invalid filters.
         self.ec2_instance_filters = defaultdict(list)
         if config.has_option('ec2', 'instance_filters'):
+            self.ec2_instance_filters = self.parse_instance_filters(config.get('ec2', 'instance_filters'))
+
+        # Accounts to fetch, each from an [account:<name>] section with its
+        # own iam_role and/or boto_profile (default: the boto_profile above),
+        # and optionally its own regions (default: the regions above) and
+        # instance_filters (default: the instance_filters above). Without
+        # any, only the account of the credentials above is fetched.
+        self.default_account = self.new_account(None, self.iam_role, self.boto_profile, None,
+                                                self.ec2_instance_filters)
+
+        # How long the fetches of an account may run, counted from the start
+        # of the refresh, before its snapshot is used instead (0: wait for
+        # them), and how old that snapshot may be (0: any age). Each
+        # [account:<name>] section may set its own.
+        fetch_timeout = 60
+        if config.has_option('ec2', 'fetch_timeout'):
+            fetch_timeout = config.getint('ec2', 'fetch_timeout')
+        snapshot_max_age = 86400
+        if config.has_option('ec2', 'snapshot_max_age'):
+            snapshot_max_age = config.getint('ec2', 'snapshot_max_age')
+
+        self.accounts = []
+        for section in config.sections():
+            if not section.startswith('account:'):
+                continue
+            name = section[len('account:'):]
+            if not re.match(r'^[\w-]+$', name):
+                self.fail_with_error("account names may only contain letters, digits, '_' and '-': %s" % name,
+                                     "reading settings")
+            if self.eucalyptus:
+                self.fail_with_error("accounts are not supported with eucalyptus", "reading settings")
+
+            regions = None
+            if config.has_option(section, 'regions') and config.get(section, 'regions') != 'all':
+                regions = [r.strip() for r in config.get(section, 'regions').split(',') if r.strip()]
+            instance_filters = self.ec2_instance_filters
+            if config.has_option(section, 'instance_filters'):
+                instance_filters = self.parse_instance_filters(config.get(section, 'instance_filters'))
+            account = self.new_account(
+                name,
+                config.get(section, 'iam_role') if config.has_option(section, 'iam_role') else None,
+                config.get(section, 'boto_profile') if config.has_option(section, 'boto_profile') else self.boto_profile,
+                regions, instance_filters)
+            account['fetch_timeout'] = fetch_timeout
+            if config.has_option(section, 'fetch_timeout'):
+                account['fetch_timeout'] = config.getint(section, 'fetch_timeout')
+            account['snapshot_max_age'] = snapshot_max_age
+            if config.has_option(section, 'snapshot_max_age'):
+                account['snapshot_max_age'] = config.getint(section, 'snapshot_max_age')
+            self.accounts.append(account)
+
+        self.settings_fingerprint = self.get_settings_fingerprint()
+
+        self.set_cache_paths()
+
+    def set_cache_paths(self):
+        ''' Names the cache files after the credentials in use and a hash of
+        the settings that decide what the inventory contains, so that several
+        ini files sharing a cache_path (e.g. one per environment, each with
+        its own instance_filters) each keep their own cache '''
+
+        settings = {
+            'inventory': self.settings_fingerprint,
+            'regions': self.regions_setting,
+            'instance_filters': sorted(self.ec2_instance_filters.items()),
+            'stack_filters': self.stack_filters,
+            'eucalyptus_host': self.eucalyptus_host,
+            'iam_role': self.iam_role,
+            'accounts': [[a['name'], a['iam_role'], a['boto_profile'], a['regions'],
+                          sorted(a['instance_filters'].items())] for a in self.accounts],
+            'pretty_json': self.pretty_json,
+            'hoist_group_vars': self.hoist_group_vars,
+        }
+        for name in ['rds_enabled', 'all_rds_instances', 'include_rds_clusters',
+                     'elasticache_enabled', 'all_elasticache_replication_groups',
+                     'all_elasticache_clusters', 'all_elasticache_nodes',
+                     'route53_excluded_zones', 'group_by_rds_engine',
+                     'group_by_rds_parameter_group', 'group_by_elasticache_engine',
+                     'group_by_elasticache_cluster', 'group_by_elasticache_parameter_group',
+                     'group_by_elasticache_replication_group',
+                     'instance_fetch_backend', 'tag_resolution']:
+            settings[name] = getattr(self, name)
+        settings_hash = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+        cache_name = '%s-%s' % (self.cache_name, settings_hash)
+        # The host index is always local, see get_host_info_from_host_index
+        self.cache_path_host_index = os.path.join(self.cache_dir, "%s.hostdb" % cache_name)
+        # Likewise each ini file gets its own daemon
+        if self.serve_socket is None:
+            self.serve_socket = os.path.join(self.cache_dir, "%s.sock" % cache_name)
 
-            filters = [f for f in config.get('ec2', 'instance_filters').split(',') if f]
-
-            for instance_filter in filters:
-                instance_filter = instance_filter.strip()
-                if not instance_filter or '=' not in instance_filter:
-                    continue
-                filter_key, filter_value = [x.strip() for x in instance_filter.split('=', 1)]
-                if not filter_key:
-                    continue
-                self.ec2_instance_filters[filter_key].append(filter_value)
+        try:
+            if self.cache_backend_name == 'sqlite':
+                self.cache_backend = SqliteCacheBackend(self.cache_sqlite_path, cache_name)
+            elif self.cache_backend_name == 'redis':
+                self.cache_backend = RedisCacheBackend(self.cache_redis_url, cache_name)
+            else:
+                self.cache_backend = FileCacheBackend(self.cache_dir, cache_name)
+        except (CacheBackendError, ValueError) as e:
+            self.fail_with_error(str(e), 'setting up the %s cache backend' % self.cache_backend_name)
 
     def parse_cli_args(self):
         ''' Command line argument processing '''
 
-        parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on EC2')
-        parser.add_argument('--list', action='store_true', default=True,
-                           help='List instances (default: True)')
-        parser.add_argument('--host', action='store',
-                           help='Get all the variables about a specific instance')
-        parser.add_argument('--refresh-cache', action='store_true', default=False,
-                           help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
-        parser.add_argument('--profile', '--boto-profile', action='store', dest='boto_profile',
-                           help='Use boto profile for connections to EC2')
-        self.args = parser.parse_args()
+        self.args = build_arg_parser().parse_args()
+
+    def parse_instance_filters(self, value):
+        ''' Parses comma-separated key=value instance filters into a dict of
+        filter names to lists of values '''
+
+        instance_filters = defaultdict(list)
+        for instance_filter in value.split(','):
+            instance_filter = instance_filter.strip()
+            if not instance_filter or '=' not in instance_filter:
+                continue
+            filter_key, filter_value = [x.strip() for x in instance_filter.split('=', 1)]
+            if not filter_key:
+                continue
+            instance_filters[filter_key].append(filter_value)
+        return instance_filters
+
+    def new_account(self, name, iam_role, boto_profile, regions, instance_filters):
+        ''' Returns the settings of an account to fetch, and the state kept
+        for it for the whole run: its connections by service and region, the
+        credentials of its assumed iam_role, and its account ID. name is None
+        for the account of the [ec2] credentials. '''
+
+        account = {
+            'name': name,
+            'iam_role': iam_role,
+            'boto_profile': boto_profile,
+            'regions': regions,
+            'instance_filters': instance_filters,
+            'connections': {},
+            'lock': threading.Lock(),
+            'boto3_session': None,
+            'iam_role_credentials': None,
+            'cache_path_iam_role': None,
+            # Account ID reported by STS, see get_caller_account_id
+            'caller_account_id': None,
+            # Owner of its reservations, see add_for_account
+            'aws_account_id': None,
+            # See fetch_account_source and add_account_source
+            'fetch_timeout': 0,
+            'snapshot_max_age': 0,
+            'fetch_started': None,
+        }
+        if iam_role:
+            role_cache_id = hashlib.sha1('|'.join([
+                iam_role,
+                boto_profile or '',
+                os.environ.get('AWS_ACCESS_KEY_ID', self.credentials.get('aws_access_key_id')) or '',
+            ]).encode('utf-8')).hexdigest()[:16]
+            account['cache_path_iam_role'] = os.path.join(self.cache_dir, 'ansible-ec2-role-%s.json' % role_cache_id)
+        return account
+
+    def get_accounts(self):
+        ''' Returns the accounts to fetch '''
+
+        return self.accounts or [self.default_account]
+
+    def get_account_regions(self):
+        ''' Returns the (account, region) pairs to query '''
+
+        return [(account, region) for account in self.get_accounts()
+                for region in (account['regions'] or self.get_regions())]
+
+
+    def do_api_calls_update_cache(self, use_snapshots=True):
+        ''' Do API calls to each region, and save data in cache files. Sources
+        whose snapshot hasn't expired are added from it instead, unless
+        use_snapshots is False. '''
+
+        # Every fetch only talks to AWS and returns what it found; the matching
+        # add step is what mutates self.inventory and self.index. Fetches may
+        # run concurrently, but their results are always added in this order
+        # so the output is the same as a serial run.
+        self.called_aws = True
+        self.refresh_started = time()
+        sources = []
+        if self.route53_enabled:
+            sources.append(('route53', None, None, self.fetch_route53_records, self.add_route53_records))
+
+        # Every account's regions are fetched in the same pool, each with the
+        # account's own connections
+        for account in self.get_accounts():
+            account['fetch_started'] = None
+            regions = account['regions'] or self.get_regions()
+            if self.skip_empty_regions:
+                regions = self.get_regions_to_query(regions)
+
+            for region in regions:
+                sources.append(('ec2', account, region, partial(self.fetch_instances_by_region, region, account),
+                                partial(self.add_instances_by_region, region)))
+                if self.rds_enabled:
+                    sources.append(('rds', account, region, partial(self.fetch_rds_instances_by_region, region, account),
+                                    partial(self.add_rds_instances_by_region, region)))
+                if self.elasticache_enabled:
+                    sources.append(('elasticache', account, region,
+                                    partial(self.fetch_elasticache_by_region, region, account),
+                                    partial(self.add_elasticache_by_region, region)))
+                if self.include_rds_clusters:
+                    sources.append(('rds_clusters', account, region,
+                                    partial(self.fetch_rds_clusters_by_region, region, account),
+                                    partial(self.add_rds_clusters_by_region, region)))
+
+        fetches = []
+        self.source_snapshots = []
+        for source, account, region, fetch, add in sources:
+            if self.skip_empty_regions and region is not None:
+                add = partial(self.add_and_track_region, region, source, add)
+
+            if not self.use_source_snapshots():
+                fetches.append((fetch, add))
+                continue
+
+            key = self.get_source_key(source, account, region)
+            snapshot = self.load_source_snapshot(source, key) if use_snapshots else None
+            if snapshot is not None:
+                fetch = partial(lambda snapshot: snapshot, snapshot)
+                add = partial(self.add_source_snapshot, region=region)
+            elif account is not None and account['name'] is not None:
+                # Each account is its own segment of the cache: if it can't
+                # be fetched, its last snapshot is used instead
+                fetch = partial(self.fetch_account_source, account, key, fetch)
+                add = partial(self.add_account_source, account, source, region, key, add)
+            else:
+                add = partial(self.add_and_snapshot_source, source, key, add)
+
+            if account is not None and account['name'] is not None:
+                add = partial(self.add_for_account, account, add)
+            fetches.append((fetch, add))
+
+        if self.skip_empty_regions:
+            # Regions known to have resources are fetched first; the results
+            # are still added in the usual order
+            rank = self.get_region_rank
+            order = sorted(range(len(fetches)), key=lambda i: rank(sources[i][2]))
+            self.run_fetches(fetches, order)
+        else:
+            self.run_fetches(fetches)
 
+        if self.ec2_cache_adaptive:
+            self.update_ec2_adaptive_state()
 
-    def do_api_calls_update_cache(self):
-        ''' Do API calls to each region, and save data in cache files '''
+        self.write_caches()
 
+    def get_regions(self):
+        ''' Returns the regions to query. With regions = all they are listed
+        once and cached for regions_cache_max_age. '''
+
+        if self.regions is not None:
+            return self.regions
+
+        age = self.cache_backend.age('regions')
+        if age is not None and age < self.regions_cache_max_age:
+            try:
+                self.regions = json.loads(self.read_cache_file('regions'))
+                return self.regions
+            except (IOError, OSError, ValueError):
+                pass
+
+        self.called_aws = True
+        import boto
+        from boto import ec2
+        if self.eucalyptus_host:
+            self.regions = [boto.connect_euca(host=self.eucalyptus_host, **self.credentials).region.name]
+        else:
+            self.regions = [regionInfo.name for regionInfo in ec2.regions()
+                            if regionInfo.name not in self.regions_exclude]
+        self.write_to_cache(self.regions, 'regions', self.regions_cache_max_age or None)
+        return self.regions
+
+    def load_regions_state(self):
+        ''' Reads whether each region had resources at the last refresh that
+        queried it, and when that was '''
+
+        if self.regions_state is None:
+            try:
+                self.regions_state = json.loads(self.read_cache_file('regions_state'))
+            except (IOError, OSError, ValueError):
+                self.regions_state = {}
+        return self.regions_state
+
+    def get_regions_to_query(self, regions):
+        ''' Leaves out the regions that were empty at their last refresh,
+        unless they are due for another probe '''
+
+        state = self.load_regions_state()
+        now = time()
+        return [region for region in regions
+                if not state.get(region, {}).get('empty') or
+                state[region]['checked'] + self.empty_regions_probe_age <= now]
+
+    def get_region_rank(self, region):
+        ''' Sorts regions known to have resources first, then regions never
+        queried, then empty regions being probed '''
+
+        if region is None:
+            return 0
+        known = self.load_regions_state().get(region)
+        if known is None:
+            return 1
+        return 2 if known['empty'] else 0
+
+    def add_and_track_region(self, region, source, add, result):
+        ''' Runs an add step for region, and records whether the region has
+        any resources. What the fetch returned is counted, not what the
+        inventory gained: a host already added from another region under the
+        same name doesn't make this one empty. '''
+
+        found = [0]
+        if source == 'ec2':
+            # May be a stream of pages, so count the instances as they are added
+            def count_instances(reservations):
+                for reservation in reservations:
+                    found[0] += len(reservation.instances)
+                    yield reservation
+            result = count_instances(result)
+        elif source == 'elasticache':
+            clusters, replication_groups = result
+            found[0] = len(clusters) + len(replication_groups)
+        else:
+            found[0] = len(result)
+        add(result)
+        self.track_region(region, found[0] > 0)
+
+    def track_region(self, region, found):
+        ''' Records whether a source of region found any resources. The
+        region only counts as empty if none of its sources did, whether they
+        were fetched or added from their snapshot. '''
+
+        state = self.load_regions_state()
+        previous = state.get(region)
+        if previous is not None and previous['checked'] == self.refresh_started:
+            found = found or not previous['empty']
+        state[region] = {'empty': not found, 'checked': self.refresh_started}
+
+    def get_source_max_age(self, source):
+        ''' Returns how long the snapshot of a source stays fresh '''
+
+        if source == 'route53':
+            return self.route53_cache_max_age
+        if source == 'ec2' and self.ec2_cache_adaptive:
+            return self.load_ec2_adaptive_state()['max_age']
+        if source in ('rds', 'rds_clusters'):
+            return self.rds_cache_max_age
+        return getattr(self, '%s_cache_max_age' % source)
+
+    def get_enabled_sources(self):
+        sources = ['ec2']
         if self.route53_enabled:
-            self.get_route53_records()
-
-        for region in self.regions:
-            self.get_instances_by_region(region)
-            if self.rds_enabled:
-                self.get_rds_instances_by_region(region)
-            if self.elasticache_enabled:
-                self.get_elasticache_clusters_by_region(region)
-                self.get_elasticache_replication_groups_by_region(region)
-            if self.include_rds_clusters:
-                self.include_rds_clusters_by_region(region)
-
-        self.write_to_cache(self.inventory, self.cache_path_cache)
-        self.write_to_cache(self.index, self.cache_path_index)
-
-    def connect(self, region):
+            sources.append('route53')
+        if self.rds_enabled or self.include_rds_clusters:
+            sources.append('rds')
+        if self.elasticache_enabled:
+            sources.append('elasticache')
+        return sources
+
+    def get_inventory_max_age(self):
+        ''' The inventory is as old as its oldest source, so it expires with
+        the source that expires first '''
+
+        return min(self.get_source_max_age(source) for source in self.get_enabled_sources())
+
+    def use_source_snapshots(self):
+        ''' Snapshots are only worth keeping when some sources outlive the
+        inventory, i.e. when their max ages differ, or to fall back on when
+        one of several accounts can't be fetched '''
+
+        if self.ec2_cache_adaptive or self.accounts:
+            return True
+        return len(set(self.get_source_max_age(source) for source in self.get_enabled_sources())) > 1
+
+    def get_source_key(self, source, account, region):
+        ''' Returns the name of the snapshot of a source, which for the
+        sources of an [account:<name>] section starts with account.<name> '''
+
+        key = source if region is None else '%s.%s' % (source, region)
+        if account is not None and account['name'] is not None:
+            key = 'account.%s.%s' % (account['name'], key)
+        return key
+
+    def load_source_snapshot(self, source, key, max_age=None):
+        ''' Returns the snapshot of a source if it is younger than max_age
+        (default: the source's max age) '''
+
+        age = self.cache_backend.age('source.' + key)
+        if age is None or age >= (self.get_source_max_age(source) if max_age is None else max_age):
+            return None
+        try:
+            return json.loads(self.read_cache_file('source.' + key))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def add_and_snapshot_source(self, source, key, add, result):
+        ''' Runs the add step of a source against an empty inventory, keeps
+        what it added as the source's snapshot, and adds the snapshot to the
+        real inventory '''
+
+        inventory, index = self.inventory, self.index
+        self.inventory, self.index = self._empty_inventory(), {}
+        try:
+            add(result)
+            snapshot = {'inventory': self.inventory, 'index': self.index, 'aws_account_id': self.aws_account_id}
+        finally:
+            self.inventory, self.index = inventory, index
+        if source == 'route53':
+            snapshot['route53_records'] = self.route53_records
+
+        self.source_snapshots.append((source, key, self.json_format_dict(snapshot)))
+        self.add_source_snapshot(snapshot)
+
+    def fetch_account_source(self, account, key, fetch):
+        ''' Runs the fetch of a source of an [account:<name>] section, and
+        returns its result and None, or None and whatever made it fail, for
+        add_account_source to deal with. While the account has a snapshot of
+        the source to fall back on, the fetch only has until fetch_timeout
+        seconds after the account's first fetch started, so that accounts
+        queued behind a slow one still get their own time; it is then left to
+        finish in the background. '''
+
+        with account['lock']:
+            if account['fetch_started'] is None:
+                account['fetch_started'] = time()
+
+        if not account['fetch_timeout'] or self.get_account_snapshot_age(account, key) is None:
+            try:
+                return fetch(), None
+            except (Exception, SystemExit) as e:
+                return None, e
+
+        timeout = account['fetch_started'] + account['fetch_timeout'] - time()
+        fetched = [None, AccountFetchTimeout('not done within fetch_timeout = %d seconds' % account['fetch_timeout'])]
+        if timeout <= 0:
+            return fetched
+
+        def run():
+            try:
+                result = fetch()
+                if iter(result) is result:
+                    # A stream of pages (see fetch_instances_by_region) would
+                    # keep fetching while it is added, past the deadline
+                    result = list(result)
+                fetched[:] = [result, None]
+            except (Exception, SystemExit) as e:
+                fetched[:] = [None, e]
+
+        # A daemon thread, so that a fetch that never returns doesn't keep the
+        # script from exiting either
+        fetcher = threading.Thread(target=pool_task(run, on_pool_thread()))
+        fetcher.daemon = True
+        fetcher.start()
+        fetcher.join(timeout)
+        return tuple(fetched)
+
+    def get_account_snapshot_age(self, account, key):
+        ''' Returns the age of the snapshot of an account's source, or None
+        if there is none or it is older than the account's snapshot_max_age '''
+
+        age = self.cache_backend.age('source.' + key)
+        if age is None or (account['snapshot_max_age'] and age >= account['snapshot_max_age']):
+            return None
+        return age
+
+    def add_account_source(self, account, source, region, key, add, fetched):
+        ''' Adds what fetch_account_source returned for a source of an
+        [account:<name>] section, like add_and_snapshot_source. If the fetch
+        or the add step failed or timed out, the source's last snapshot is
+        added instead, unless it is older than the account's
+        snapshot_max_age, so one account that can't be reached doesn't take
+        the others down with it; without a snapshot the error is raised. '''
+
+        result, error = fetched
+        if error is None:
+            try:
+                self.add_and_snapshot_source(source, key, add, result)
+                return
+            except (Exception, SystemExit) as e:
+                error = e
+
+        age = self.get_account_snapshot_age(account, key)
+        snapshot = None if age is None else self.load_source_snapshot(source, key, max_age=float('inf'))
+        if snapshot is None:
+            if isinstance(error, AccountFetchTimeout):
+                self.fail_with_error(str(error), 'refreshing %s' % key)
+            raise error
+        if isinstance(error, SystemExit):
+            # fail_with_error has written the error, without a newline
+            sys.stderr.write('\n')
+        else:
+            sys.stderr.write('ERROR: "%s", while: refreshing %s\n' % (error, key))
+        sys.stderr.write('WARNING: using the snapshot of %s from %d seconds ago\n' % (key, age))
+        self.add_source_snapshot(snapshot, region)
+
+    def add_for_account(self, account, add, result):
+        ''' Runs an add step of a source of an [account:<name>] section, with
+        aws_account_id set to that account's (or unknown until its first
+        reservation is added), for group_by_aws_account and ec2_account_id '''
+
+        self.aws_account_id = account['aws_account_id']
+        try:
+            add(result)
+        finally:
+            account['aws_account_id'] = self.aws_account_id
+
+    def add_source_snapshot(self, snapshot, region=None):
+        ''' Adds what a source's add step added to an empty inventory to the
+        real one, with the same push and push_group calls, so the result is
+        the same as running the add step itself. With skip_empty_regions,
+        region is tracked as if the source had been fetched. '''
+
+        for key, value in snapshot['inventory'].items():
+            if key == '_meta':
+                self.inventory['_meta']['hostvars'].update(value['hostvars'])
+            elif key == 'db_clusters':
+                # Not a group; each region's clusters replace the previous
+                self.inventory[key] = value
+            elif isinstance(value, dict):
+                for element in value.get('children', []):
+                    self.push_group(self.inventory, key, element)
+                for element in value.get('hosts', []):
+                    self.push(self.inventory, key, element)
+            else:
+                for element in value:
+                    self.push(self.inventory, key, element)
+
+        self.index.update(snapshot['index'])
+        if not self.aws_account_id:
+            self.aws_account_id = snapshot['aws_account_id']
+        if 'route53_records' in snapshot:
+            self.add_route53_records(snapshot['route53_records'])
+
+        if self.skip_empty_regions and region is not None:
+            self.track_region(region, any(value for key, value in snapshot['inventory'].items() if key != '_meta'))
+
+    def load_ec2_adaptive_state(self):
+        ''' Reads the current adaptive EC2 max age, the recent churn and the
+        hashes of the hosts seen in each region '''
+
+        if self.ec2_adaptive_state is None:
+            try:
+                self.ec2_adaptive_state = json.loads(self.read_cache_file('ec2_adaptive'))
+            except (IOError, OSError, ValueError):
+                self.ec2_adaptive_state = {'max_age': self.ec2_cache_max_age, 'churn': [], 'hosts': {}}
+            self.ec2_adaptive_state['max_age'] = min(max(self.ec2_adaptive_state['max_age'],
+                                                         self.ec2_cache_adaptive_min_age),
+                                                     self.ec2_cache_adaptive_max_age)
+        return self.ec2_adaptive_state
+
+    def update_ec2_adaptive_state(self):
+        ''' Measures the churn of the EC2 regions refreshed in this run, i.e.
+        the share of hosts added, removed or changed, and adapts the EC2 max
+        age to the churn of the last few refreshes '''
+
+        state = self.load_ec2_adaptive_state()
+        changed = total = 0
+        for source, key, text in self.source_snapshots:
+            if source != 'ec2':
+                continue
+            snapshot = json.loads(text)
+            hosts = sorted(hashlib.sha1(self.json_format_dict(hostvars).encode('utf-8')).hexdigest()[:16]
+                           for hostvars in snapshot['inventory']['_meta']['hostvars'].values())
+            previous = state['hosts'].get(key)
+            if previous is not None:
+                changed += len(set(previous) ^ set(hosts))
+                total += len(previous) + len(hosts)
+            state['hosts'][key] = hosts
+
+        if total:
+            state['churn'] = (state['churn'] + [float(changed) / total])[-5:]
+            if not any(state['churn']):
+                state['max_age'] = min(state['max_age'] * 2, self.ec2_cache_adaptive_max_age)
+            elif sum(state['churn']) / len(state['churn']) > 0.05:
+                state['max_age'] = max(state['max_age'] // 2, self.ec2_cache_adaptive_min_age)
+
+    def write_caches(self, published=None):
+        ''' Publishes the inventory and index to the cache backend, all at
+        once, and writes the local host index. The inventory comes last, as
+        its age is what marks the cache valid. The entries are dated now, or
+        published if given. '''
+
+        inventory_entry, generation = self.write_inventory_entry()
+
+        # Entries disappear once they are too old to be served at all
+        ttl = self.get_inventory_max_age() + self.cache_stale_while_revalidate
+        if ttl <= 0:
+            ttl = None
+
+        entries = [
+            ('index', self.encode_cache_entry(self.json_format_dict(self.index)), ttl),
+            ('generation', generation.encode('ascii'), ttl),
+            ('cache', inventory_entry, ttl),
+        ]
+        for source, key, text in self.source_snapshots:
+            # Snapshots of accounts are kept to fall back on, see
+            # add_account_source
+            source_ttl = None if key.startswith('account.') else self.get_source_max_age(source) or None
+            entries.insert(0, ('source.' + key, self.encode_cache_entry(text), source_ttl))
+        if self.skip_empty_regions and self.regions_state is not None:
+            entries.insert(0, ('regions_state', self.encode_cache_entry(self.json_format_dict(self.regions_state)),
+                               None))
+        if self.ec2_cache_adaptive and self.ec2_adaptive_state is not None:
+            entries.insert(0, ('ec2_adaptive', self.encode_cache_entry(self.json_format_dict(self.ec2_adaptive_state)),
+                               None))
+        self.source_snapshots = []
+        self.write_host_index(self.inventory['_meta']['hostvars'], self.index, generation)
+        with inventory_entry:
+            self.cache_backend.publish(entries, published)
+
+    def write_inventory_entry(self):
+        ''' Serializes the inventory a group or host at a time, to a temporary
+        file holding the cache entry (compressed if cache_compression is set)
+        and to inventory_out if set, followed there by a newline. Returns the
+        file, rewound, and the generation of the inventory: a hash of its
+        JSON text. '''
+
+        import tempfile
+        entry = tempfile.TemporaryFile()
+        compressor = None
+        if self.cache_compression == 'gzip':
+            compressor = gzip.GzipFile(fileobj=entry, mode='wb', compresslevel=6, mtime=0)
+        sink = compressor or entry
+        digest = hashlib.sha1()
+        out = self.inventory_out
+
+        inventory = self.inventory
+        if self.hoist_group_vars:
+            # Only in what is written: the host index and --host keep every
+            # hostvar of each host
+            inventory = hoist_group_vars(inventory)
+
+        # Groups, then hosts of _meta.hostvars, a batch at a time
+        for chunk in iter_json(inventory, self.pretty_json, {'_meta': {'hostvars': {}}}):
+            data = chunk.encode('utf-8')
+            sink.write(data)
+            digest.update(data)
+            if out is not None:
+                out.write(data)
+
+        if compressor is not None:
+            compressor.close()
+        if out is not None:
+            out.write(b'\n')
+            out.flush()
+        self.inventory_written = True
+        entry.seek(0)
+        return entry, digest.hexdigest()[:16]
+
+    def run_fetches(self, fetches, order=None):
+        ''' Runs a list of (fetch, add) pairs, passing the result of each fetch
+        to its add function. With max_workers > 1 the fetches run in a bounded
+        thread pool, started in the order of the indexes in order if given,
+        and each result is added as soon as it and every fetch before it in
+        the list have completed. On a pool thread they run one by one. '''
+
+        if self.max_workers <= 1 or len(fetches) <= 1 or on_pool_thread():
+            for fetch, add in fetches:
+                add(fetch())
+            return
+
+        with self.thread_pool(self.max_workers) as executor:
+            futures = [None] * len(fetches)
+            for i in (order if order is not None else range(len(fetches))):
+                futures[i] = executor.submit(pool_task(fetches[i][0]))
+            for (fetch, add), future in zip(fetches, futures):
+                add(future.result())
+
+    def map_concurrently(self, func, items):
+        ''' Like map(), but uses up to max_workers threads, unless called on
+        a pool thread, which already counts against max_workers. Results are
+        returned in the order of items. '''
+
+        items = list(items)
+        if self.max_workers <= 1 or len(items) <= 1 or on_pool_thread():
+            return [func(item) for item in items]
+
+        with self.thread_pool(min(self.max_workers, len(items))) as executor:
+            return list(executor.map(pool_task(func), items))
+
+    def thread_pool(self, max_workers):
+        ''' Returns a ThreadPoolExecutor. concurrent.futures is only imported
+        when max_workers > 1 actually has fetches to run concurrently. '''
+
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            self.fail_with_error("max_workers > 1 requires the concurrent.futures module - please install futures and try again",
+                                 "starting worker threads")
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    def connect(self, region, account=None):
         ''' create connection to api server'''
         if self.eucalyptus:
-            conn = boto.connect_euca(host=self.eucalyptus_host, **self.credentials)
-            conn.APIVersion = '2010-08-31'
+            import boto
+            account = self.default_account
+            with account['lock']:
+                conn = account['connections'].get(('euca', region))
+                if conn is None:
+                    conn = boto.connect_euca(host=self.eucalyptus_host, **self.credentials)
+                    conn.APIVersion = '2010-08-31'
+                    account['connections'][('euca', region)] = conn
         else:
-            conn = self.connect_to_aws(ec2, region)
+            conn = self.connect_to_aws('ec2', region, account)
         return conn
 
     def boto_fix_security_token_in_profile(self, connect_args):
         ''' monkey patch for boto issue boto/boto#2100 '''
-        profile = 'profile ' + self.boto_profile
+        import boto
+        profile = 'profile ' + connect_args['profile_name']
         if boto.config.has_option(profile, 'aws_security_token'):
             connect_args['security_token'] = boto.config.get(profile, 'aws_security_token')
         return connect_args
 
-    def connect_to_aws(self, module, region):
-        connect_args = self.credentials
+    def connect_to_aws(self, service, region, account=None):
+        ''' Returns a connection to region from the boto module of service
+        (e.g. 'rds'), for account (default: the account of the [ec2]
+        credentials). Connections are reused for the rest of the run, so
+        their keep-alive HTTP connections are shared by every call to the
+        same service and region. Each account has its own lock, so accounts
+        assume their roles and connect concurrently. '''
+
+        account = account or self.default_account
+        key = (service, region)
+        with account['lock']:
+            conn = account['connections'].get(key)
+            if conn is None:
+                conn = account['connections'][key] = self._connect_to_aws(service, region, account)
+        return conn
 
-        # only pass the profile name if it's set (as it is not supported by older boto versions)
-        if self.boto_profile:
-            connect_args['profile_name'] = self.boto_profile
-            self.boto_fix_security_token_in_profile(connect_args)
+    def _connect_to_aws(self, service, region, account):
+        module = importlib.import_module('boto.%s' % service)
+        connect_args = self.get_connect_args(account)
 
-        if self.iam_role:
-            sts_conn = sts.connect_to_region(region, **connect_args)
-            role = sts_conn.assume_role(self.iam_role, 'ansible_dynamic_inventory')
-            connect_args['aws_access_key_id'] = role.credentials.access_key
-            connect_args['aws_secret_access_key'] = role.credentials.secret_key
-            connect_args['security_token'] = role.credentials.session_token
+        if account['iam_role']:
+            role_credentials = self.get_iam_role_credentials(region, account)
+            connect_args['aws_access_key_id'] = role_credentials['access_key']
+            connect_args['aws_secret_access_key'] = role_credentials['secret_key']
+            connect_args['security_token'] = role_credentials['session_token']
 
         conn = module.connect_to_region(region, **connect_args)
         # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
@@ -568,50 +2677,167 @@ class Ec2Inventory(object):
             self.fail_with_error("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
         return conn
 
-    def get_instances_by_region(self, region):
-        ''' Makes an AWS EC2 API call to the list of instances in a particular
-        region '''
+    def get_connect_args(self, account=None):
+        ''' Returns the boto connection arguments for the configured
+        credentials or the profile of account '''
+
+        account = account or self.default_account
+        connect_args = dict(self.credentials)
+
+        # only pass the profile name if it's set (as it is not supported by older boto versions)
+        if account['boto_profile']:
+            # pre 2.24 boto will fall over with it
+            import boto.ec2
+            if not hasattr(boto.ec2.EC2Connection, 'profile_name'):
+                self.fail_with_error("boto version must be >= 2.24 to use profile")
+            connect_args['profile_name'] = account['boto_profile']
+            self.boto_fix_security_token_in_profile(connect_args)
+
+        return connect_args
+
+    def connect_to_aws_boto3(self, service, region, account=None):
+        ''' Returns a boto3 client for service in region, using the same
+        profile, credentials and IAM role as connect_to_aws. Clients are
+        reused for the rest of the run like boto connections. '''
+
+        account = account or self.default_account
+        key = ('boto3', service, region)
+        with account['lock']:
+            client = account['connections'].get(key)
+            if client is None:
+                client = account['connections'][key] = self._connect_to_aws_boto3(service, region, account)
+        return client
+
+    def _connect_to_aws_boto3(self, service, region, account):
+        boto3 = import_boto3()
+        if boto3 is None:
+            self.fail_with_error("instance_fetch_backend = boto3 requires boto3 - please install boto3 and try again",
+                                 "connecting to AWS")
+        from botocore.config import Config
+
+        if account['boto3_session'] is None:
+            session_args = {}
+            if account['boto_profile']:
+                session_args['profile_name'] = account['boto_profile']
+            if self.credentials:
+                session_args['aws_access_key_id'] = self.credentials['aws_access_key_id']
+                session_args['aws_secret_access_key'] = self.credentials['aws_secret_access_key']
+                session_args['aws_session_token'] = self.credentials.get('security_token')
+            account['boto3_session'] = boto3.session.Session(**session_args)
+
+        client_args = {}
+        if account['iam_role']:
+            role_credentials = self.get_iam_role_credentials(region, account)
+            client_args['aws_access_key_id'] = role_credentials['access_key']
+            client_args['aws_secret_access_key'] = role_credentials['secret_key']
+            client_args['aws_session_token'] = role_credentials['session_token']
+
+        # Let every worker keep its own connection alive
+        config = Config(max_pool_connections=max(10, self.max_workers))
+        return account['boto3_session'].client(service, region_name=region, config=config, **client_args)
+
+    def get_iam_role_credentials(self, region, account):
+        ''' Assumes the iam_role of account, at most once per run. With
+        cache_iam_role_credentials the credentials are also kept in the cache
+        directory (readable only by the current user) and reused by later runs
+        until shortly before they expire. '''
+
+        now = time()
+        credentials = account['iam_role_credentials']
+        if credentials and credentials['expiration'] - self.iam_role_credentials_margin > now:
+            return credentials
+
+        if self.cache_iam_role_credentials:
+            credentials = self.read_iam_role_credentials_cache(account['cache_path_iam_role'])
+            if credentials and credentials['expiration'] - self.iam_role_credentials_margin > now:
+                account['iam_role_credentials'] = credentials
+                return credentials
+
+        from boto import sts
+        sts_conn = sts.connect_to_region(region, **self.get_connect_args(account))
+        role = sts_conn.assume_role(account['iam_role'], 'ansible_dynamic_inventory')
+        credentials = {
+            'access_key': role.credentials.access_key,
+            'secret_key': role.credentials.secret_key,
+            'session_token': role.credentials.session_token,
+            # e.g. 2018-05-16T21:15:19Z, possibly with fractional seconds
+            'expiration': calendar.timegm(time_module.strptime(role.credentials.expiration[:19], '%Y-%m-%dT%H:%M:%S')),
+        }
+        account['iam_role_credentials'] = credentials
+
+        if self.cache_iam_role_credentials:
+            self.write_iam_role_credentials_cache(account['cache_path_iam_role'], credentials)
+
+        return credentials
+
+    def read_iam_role_credentials_cache(self, path):
+        ''' Returns the assumed-role credentials cached at path, or None '''
 
         try:
-            conn = self.connect(region)
-            reservations = []
-            if self.ec2_instance_filters:
-                if self.stack_filters:
-                    filters_dict = {}
-                    for filter_key, filter_values in self.ec2_instance_filters.items():
-                        filters_dict[filter_key] = filter_values
-                    reservations.extend(conn.get_all_instances(filters = filters_dict))
-                else:
-                    for filter_key, filter_values in self.ec2_instance_filters.items():
-                        reservations.extend(conn.get_all_instances(filters = { filter_key : filter_values }))
-            else:
-                reservations = conn.get_all_instances()
+            # Don't trust credentials that others could have written
+            if os.stat(path).st_mode & 0o077:
+                return None
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_iam_role_credentials_cache(self, path, credentials):
+        ''' Writes the assumed-role credentials to path with file mode 0600 '''
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(credentials, f)
+        os.rename(tmp_path, path)
+
+    def get_instance_filter_sets(self, account, extra_filters=None):
+        ''' Returns the filters of each describe call that fetches the
+        instances of account: all of its instance_filters at once with
+        stack_filters, else one call per filter. extra_filters are added to
+        every call. '''
+
+        instance_filters = account['instance_filters']
+        if not instance_filters:
+            filter_sets = [{}]
+        elif self.stack_filters:
+            filter_sets = [dict(instance_filters)]
+        else:
+            filter_sets = [{k: v} for k, v in instance_filters.items()]
 
-            # Pull the tags back in a second step
-            # AWS are on record as saying that the tags fetched in the first `get_all_instances` request are not
-            # reliable and may be missing, and the only way to guarantee they are there is by calling `get_all_tags`
-            instance_ids = []
-            for reservation in reservations:
-                instance_ids.extend([instance.id for instance in reservation.instances])
+        for filters in filter_sets:
+            filters.update(extra_filters or {})
+        return filter_sets
+
+    def fetch_instances_by_region(self, region, account=None, extra_filters=None):
+        ''' Makes an AWS EC2 API call to the list of instances in a particular
+        region, of account (default: the account of the [ec2] credentials),
+        narrowed down by extra_filters if given '''
 
-            max_filter_value = 199
-            tags = []
-            for i in range(0, len(instance_ids), max_filter_value):
-                tags.extend(conn.get_all_tags(filters={'resource-type': 'instance', 'resource-id': instance_ids[i:i+max_filter_value]}))
+        account = account or self.default_account
+        if self.instance_fetch_backend == 'boto3':
+            # Keep one page ahead of add_instances_by_region so group building
+            # overlaps the next describe_instances call
+            return chain.from_iterable(prefetch(self.iter_instance_pages_boto3(region, account, extra_filters)))
 
-            tags_by_instance_id = defaultdict(dict)
-            for tag in tags:
-                tags_by_instance_id[tag.res_id][tag.name] = tag.value
+        from boto.exception import BotoServerError
+        try:
+            conn = self.connect(region, account)
+            reservations = []
+            for filters in self.get_instance_filter_sets(account, extra_filters):
+                reservations.extend(conn.get_all_instances(filters=filters))
 
-            if (not self.aws_account_id) and reservations:
-                self.aws_account_id = reservations[0].owner_id
+            def fetch_tags(instance_ids):
+                tags_by_instance_id = defaultdict(dict)
+                for tag in conn.get_all_tags(filters={'resource-type': 'instance', 'resource-id': instance_ids}):
+                    tags_by_instance_id[tag.res_id][tag.name] = tag.value
+                return tags_by_instance_id
 
-            for reservation in reservations:
-                for instance in reservation.instances:
-                    instance.tags = tags_by_instance_id[instance.id]
-                    self.add_instance(instance, region)
+            self.resolve_instance_tags([i for r in reservations for i in r.instances], fetch_tags)
+
+            return reservations
 
-        except boto.exception.BotoServerError as e:
+        except BotoServerError as e:
             if e.error_code == 'AuthFailure':
                 error = self.get_auth_error_message()
             else:
@@ -619,22 +2845,140 @@ class Ec2Inventory(object):
                 error = "Error connecting to %s backend.\n%s" % (backend, e.message)
             self.fail_with_error(error, 'getting EC2 instances')
 
-    def get_rds_instances_by_region(self, region):
+    def iter_instance_pages_boto3(self, region, account, extra_filters=None):
+        ''' Pages through describe_instances with boto3, yielding the
+        reservations of one page at a time with their tags resolved. Only a
+        single page of instances is held in memory. '''
+
+        from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError
+
+        try:
+            client = self.connect_to_aws_boto3('ec2', region, account)
+            paginator = client.get_paginator('describe_instances')
+            tag_paginator = client.get_paginator('describe_tags')
+
+            def fetch_tags(instance_ids):
+                tags_by_instance_id = defaultdict(dict)
+                tag_pages = tag_paginator.paginate(Filters=[
+                    {'Name': 'resource-type', 'Values': ['instance']},
+                    {'Name': 'resource-id', 'Values': instance_ids}])
+                for tag_page in tag_pages:
+                    for tag in tag_page.get('Tags', []):
+                        tags_by_instance_id[tag['ResourceId']][tag['Key']] = tag['Value']
+                return tags_by_instance_id
+
+            # Pages of max_filter_value instances resolve their tags in one call
+            for filters in self.get_instance_filter_sets(account, extra_filters):
+                pages = paginator.paginate(
+                    Filters=[{'Name': k, 'Values': v} for k, v in filters.items()],
+                    PaginationConfig={'PageSize': self.max_filter_value})
+
+                for page in pages:
+                    reservations = [Boto3Reservation(r, region) for r in page.get('Reservations', [])]
+                    instances = [i for r in reservations for i in r.instances]
+                    if not instances:
+                        continue
+
+                    self.resolve_instance_tags(instances, fetch_tags)
+
+                    yield reservations
+
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') == 'AuthFailure':
+                error = self.get_auth_error_message()
+            else:
+                error = "Error connecting to AWS backend.\n%s" % e
+            self.fail_with_error(error, 'getting EC2 instances')
+        except NoCredentialsError:
+            self.fail_with_error(self.get_auth_error_message(), 'getting EC2 instances')
+        except BotoCoreError as e:
+            self.fail_with_error("Error connecting to AWS backend.\n%s" % e, 'getting EC2 instances')
+
+    def resolve_instance_tags(self, instances, fetch_tags):
+        ''' Pull the tags back in a second step, according to tag_resolution.
+        AWS are on record as saying that the tags fetched in the first describe
+        request are not reliable and may be missing, and the only way to
+        guarantee they are there is by fetching them again. fetch_tags takes up
+        to max_filter_value instance IDs and returns a dict of instance ID to
+        tags. '''
+
+        if self.tag_resolution == 'trust_describe':
+            return
+
+        if self.tag_resolution == 'verify_sample':
+            untagged = [i for i in instances if not i.tags]
+            tagged = [i for i in instances if i.tags]
+            sample = random.sample(tagged, min(self.tag_verify_sample_size, len(tagged)))
+            tags_by_instance_id = self.fetch_tags_in_chunks(fetch_tags, [i.id for i in untagged + sample])
+
+            if all(tags_by_instance_id.get(i.id, {}) == i.tags for i in sample):
+                for instance in untagged:
+                    instance.tags = tags_by_instance_id.get(instance.id, {})
+                return
+            # The sample disagrees with describe, so don't trust any of it
+
+        tags_by_instance_id = self.fetch_tags_in_chunks(fetch_tags, [i.id for i in instances])
+        for instance in instances:
+            instance.tags = tags_by_instance_id.get(instance.id, {})
+
+    def fetch_tags_in_chunks(self, fetch_tags, instance_ids):
+        ''' Calls fetch_tags concurrently on chunks of max_filter_value
+        instance IDs and merges the results '''
+
+        chunks = [instance_ids[i:i+self.max_filter_value]
+                  for i in range(0, len(instance_ids), self.max_filter_value)]
+        tags_by_instance_id = {}
+        for chunk_tags in self.map_concurrently(fetch_tags, chunks):
+            tags_by_instance_id.update(chunk_tags)
+        return tags_by_instance_id
+
+    def add_instances_by_region(self, region, reservations):
+        ''' Adds the reservations fetched for a region to the inventory.
+        reservations may be any iterable, including a stream of pages. '''
+
+        for reservation in reservations:
+            if not self.aws_account_id:
+                self.aws_account_id = reservation.owner_id
+            for instance in reservation.instances:
+                self.add_instance(instance, region)
+
+    def get_settings_fingerprint(self):
+        ''' Hashes the settings that change how instances are turned into
+        groups and hostvars '''
+
+        settings = dict((name, getattr(self, name, None)) for name in [
+            'destination_variable', 'vpc_destination_variable', 'hostname_variable',
+            'destination_format', 'destination_format_tags', 'route53_enabled',
+            'route53_hostnames', 'ec2_instance_states', 'expand_csv_tags',
+            'nested_groups', 'replace_dash_in_groups', 'group_by_instance_id',
+            'group_by_region', 'group_by_availability_zone', 'group_by_ami_id',
+            'group_by_instance_type', 'group_by_instance_state', 'group_by_key_pair',
+            'group_by_vpc_id', 'group_by_security_group', 'group_by_tag_keys',
+            'group_by_tag_none', 'group_by_route53_names', 'group_by_aws_account',
+        ])
+        settings['pattern_include'] = self.pattern_include.pattern if self.pattern_include else None
+        settings['pattern_exclude'] = self.pattern_exclude.pattern if self.pattern_exclude else None
+        settings['hostvars_include'] = [pattern.pattern for pattern in self.hostvars_include]
+        settings['hostvars_exclude'] = [pattern.pattern for pattern in self.hostvars_exclude]
+        return hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def fetch_rds_instances_by_region(self, region, account=None):
         ''' Makes an AWS API call to the list of RDS instances in a particular
-        region '''
+        region, of account '''
 
+        from boto.exception import BotoServerError
+        db_instances = []
         try:
-            conn = self.connect_to_aws(rds, region)
+            conn = self.connect_to_aws('rds', region, account)
             if conn:
                 marker = None
                 while True:
                     instances = conn.get_all_dbinstances(marker=marker)
                     marker = instances.marker
-                    for instance in instances:
-                        self.add_rds_instance(instance, region)
+                    db_instances.extend(instances)
                     if not marker:
                         break
-        except boto.exception.BotoServerError as e:
+        except BotoServerError as e:
             error = e.reason
 
             if e.error_code == 'AuthFailure':
@@ -643,12 +2987,29 @@ class Ec2Inventory(object):
                 error = "Looks like AWS RDS is down:\n%s" % e.message
             self.fail_with_error(error, 'getting RDS instances')
 
-    def include_rds_clusters_by_region(self, region):
-        if not HAS_BOTO3:
+        return db_instances
+
+    def add_rds_instances_by_region(self, region, db_instances):
+        ''' Adds the RDS instances fetched for a region to the inventory '''
+
+        for instance in db_instances:
+            self.add_rds_instance(instance, region)
+
+    def fetch_rds_clusters_by_region(self, region, account=None):
+        ''' Makes an AWS API call to the list of RDS clusters in a particular
+        region, of account, returning the clusters that match the account's
+        instance filters '''
+
+        account = account or self.default_account
+        instance_filters = account['instance_filters']
+
+        if import_boto3() is None:
             self.fail_with_error("Working with RDS clusters requires boto3 - please install boto3 and try again",
                                  "getting RDS clusters")
 
-        client = ec2_utils.boto3_inventory_conn('client', 'rds', region, **self.credentials)
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        client = self.connect_to_aws_boto3('rds', region, account)
 
         marker, clusters = '', []
         while marker is not None:
@@ -656,9 +3017,45 @@ class Ec2Inventory(object):
             clusters.extend(resp["DBClusters"])
             marker = resp.get('Marker', None)
 
-        account_id = boto.connect_iam().get_user().arn.split(':')[4]
+        if account is self.default_account:
+            account_id = self.aws_account_id
+        else:
+            account_id = account['aws_account_id']
+        account_id = account_id or self.get_caller_account_id(region, account)
+
+        def fetch_cluster_tags(c):
+            try:
+                # arn:aws:rds:<region>:<account number>:<resourcetype>:<name>
+                tags = client.list_tags_for_resource(
+                    ResourceName='arn:aws:rds:' + region + ':' + account_id + ':cluster:' + c['DBClusterIdentifier'])
+                return tags['TagList']
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code in ('DBClusterNotFoundFault', 'DBInstanceNotFound'):
+                    # AWS RDS bug (2016-01-06) means deletion does not fully complete and leave an 'empty' cluster.
+                    # Ignore errors when trying to find tags for these
+                    return None
+                if code == 'AuthFailure':
+                    error = self.get_auth_error_message()
+                else:
+                    error = "Error connecting to AWS backend.\n%s" % e
+                self.fail_with_error(error, 'getting RDS cluster tags')
+            except BotoCoreError as e:
+                self.fail_with_error("Error connecting to AWS backend.\n%s" % e, 'getting RDS cluster tags')
+
+        # ignore empty clusters caused by AWS bug
+        clusters = [c for c in clusters if len(c['DBClusterMembers']) > 0]
+
+        # (tag name, value) pairs accepted by the filters, e.g. tag:env=prod
+        # gives ('env', 'prod'). A cluster matches if it has any of them.
+        filter_tags = set()
+        for filter_key, filter_values in instance_filters.items():
+            if ':' in filter_key:
+                tag_name = filter_key.split(":", 1)[1]
+                filter_tags.update((tag_name, value) for value in filter_values)
+
         c_dict = {}
-        for c in clusters:
+        for c, tags in zip(clusters, self.map_concurrently(fetch_cluster_tags, clusters)):
             # remove these datetime objects as there is no serialisation to json
             # currently in place and we don't need the data yet
             if 'EarliestRestorableTime' in c:
@@ -666,108 +3063,113 @@ class Ec2Inventory(object):
             if 'LatestRestorableTime' in c:
                 del c['LatestRestorableTime']
 
-            if self.ec2_instance_filters == {}:
+            if tags is not None:
+                c['Tags'] = tags
+
+            if not instance_filters:
                 matches_filter = True
             else:
-                matches_filter = False
+                matches_filter = any((d['Key'], d['Value']) in filter_tags for d in tags or [])
 
-            try:
-                # arn:aws:rds:<region>:<account number>:<resourcetype>:<name>
-                tags = client.list_tags_for_resource(
-                    ResourceName='arn:aws:rds:' + region + ':' + account_id + ':cluster:' + c['DBClusterIdentifier'])
-                c['Tags'] = tags['TagList']
+            if matches_filter:
+                c_dict[c['DBClusterIdentifier']] = c
 
-                if self.ec2_instance_filters:
-                    for filter_key, filter_values in self.ec2_instance_filters.items():
-                        # get AWS tag key e.g. tag:env will be 'env'
-                        tag_name = filter_key.split(":", 1)[1]
-                        # Filter values is a list (if you put multiple values for the same tag name)
-                        matches_filter = any(d['Key'] == tag_name and d['Value'] in filter_values for d in c['Tags'])
+        return c_dict
 
-                        if matches_filter:
-                            # it matches a filter, so stop looking for further matches
-                            break
+    def get_caller_account_id(self, region, account=None):
+        ''' Returns the ID of the AWS account we are connected to for account,
+        asking STS at most once per run '''
 
-            except Exception as e:
-                if e.message.find('DBInstanceNotFound') >= 0:
-                    # AWS RDS bug (2016-01-06) means deletion does not fully complete and leave an 'empty' cluster.
-                    # Ignore errors when trying to find tags for these
-                    pass
+        account = account or self.default_account
+        if account['caller_account_id'] is None:
+            account['caller_account_id'] = self.connect_to_aws_boto3(
+                'sts', region, account).get_caller_identity()['Account']
+        return account['caller_account_id']
 
-            # ignore empty clusters caused by AWS bug
-            if len(c['DBClusterMembers']) == 0:
-                continue
-            elif matches_filter:
-                c_dict[c['DBClusterIdentifier']] = c
+    def add_rds_clusters_by_region(self, region, c_dict):
+        ''' Adds the RDS clusters fetched for a region to the inventory '''
 
         self.inventory['db_clusters'] = c_dict
 
-    def get_elasticache_clusters_by_region(self, region):
-        ''' Makes an AWS API call to the list of ElastiCache clusters (with
-        nodes' info) in a particular region.'''
+    def fetch_elasticache_by_region(self, region, account=None):
+        ''' Makes the AWS API calls to list the ElastiCache clusters (with
+        nodes' info) and replication groups in a particular region, of
+        account. Both lists are fetched concurrently over the same
+        connection. '''
+
+        conn = self.connect_to_aws('elasticache', region, account)
+        return self.map_concurrently(lambda fetch: fetch(conn), [
+            self.fetch_elasticache_clusters, self.fetch_elasticache_replication_groups])
+
+    def fetch_elasticache_clusters(self, conn):
+        ''' Lists every ElastiCache cluster, following pagination '''
 
         # ElastiCache boto module doesn't provide a get_all_intances method,
         # that's why we need to call describe directly (it would be called by
         # the shorthand method anyway...)
-        try:
-            conn = self.connect_to_aws(elasticache, region)
-            if conn:
-                # show_cache_node_info = True
-                # because we also want nodes' information
-                response = conn.describe_cache_clusters(None, None, None, True)
-
-        except boto.exception.BotoServerError as e:
-            error = e.reason
-
-            if e.error_code == 'AuthFailure':
-                error = self.get_auth_error_message()
-            if not e.reason == "Forbidden":
-                error = "Looks like AWS ElastiCache is down:\n%s" % e.message
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+        # show_cache_node_info = True because we also want nodes' information
+        return self.describe_elasticache(
+            lambda marker: conn.describe_cache_clusters(marker=marker, show_cache_node_info=True),
+            'DescribeCacheClusters', 'CacheClusters', 'ElastiCache')
+
+    def fetch_elasticache_replication_groups(self, conn):
+        ''' Lists every ElastiCache replication group, following pagination '''
+
+        return self.describe_elasticache(
+            lambda marker: conn.describe_replication_groups(marker=marker),
+            'DescribeReplicationGroups', 'ReplicationGroups', 'ElastiCache [Replication Groups]')
+
+    def describe_elasticache(self, describe, action, result_key, service_name):
+        ''' Calls describe(marker) until the response has no Marker, and
+        returns the items found under result_key '''
+
+        from boto.exception import BotoServerError
+        items = []
+        marker = None
+        while True:
+            try:
+                response = describe(marker)
 
-        try:
-            # Boto also doesn't provide wrapper classes to CacheClusters or
-            # CacheNodes. Because of that we can't make use of the get_list
-            # method in the AWSQueryConnection. Let's do the work manually
-            clusters = response['DescribeCacheClustersResponse']['DescribeCacheClustersResult']['CacheClusters']
+            except BotoServerError as e:
+                error = e.reason
 
-        except KeyError as e:
-            error = "ElastiCache query to AWS failed (unexpected format)."
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+                if e.error_code == 'AuthFailure':
+                    error = self.get_auth_error_message()
+                if not e.reason == "Forbidden":
+                    error = "Looks like AWS %s is down:\n%s" % (service_name, e.message)
+                self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        for cluster in clusters:
-            self.add_elasticache_cluster(cluster, region)
+            try:
+                # Boto also doesn't provide wrapper classes to CacheClusters,
+                # CacheNodes or ReplicationGroups. Because of that we can't make
+                # use of the get_list method in the AWSQueryConnection. Let's do
+                # the work manually
+                result = response[action + 'Response'][action + 'Result']
+                items.extend(result[result_key])
 
-    def get_elasticache_replication_groups_by_region(self, region):
-        ''' Makes an AWS API call to the list of ElastiCache replication groups
-        in a particular region.'''
+            except KeyError:
+                error = "%s query to AWS failed (unexpected format)." % service_name
+                self.fail_with_error(error, 'getting ElastiCache clusters')
 
-        # ElastiCache boto module doesn't provide a get_all_intances method,
-        # that's why we need to call describe directly (it would be called by
-        # the shorthand method anyway...)
-        try:
-            conn = self.connect_to_aws(elasticache, region)
-            if conn:
-                response = conn.describe_replication_groups()
+            marker = result.get('Marker')
+            if not marker:
+                return items
 
-        except boto.exception.BotoServerError as e:
-            error = e.reason
+    def add_elasticache_by_region(self, region, elasticache_resources):
+        ''' Adds the ElastiCache clusters and replication groups fetched for a
+        region to the inventory '''
 
-            if e.error_code == 'AuthFailure':
-                error = self.get_auth_error_message()
-            if not e.reason == "Forbidden":
-                error = "Looks like AWS ElastiCache [Replication Groups] is down:\n%s" % e.message
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+        clusters, replication_groups = elasticache_resources
 
-        try:
-            # Boto also doesn't provide wrapper classes to ReplicationGroups
-            # Because of that we can't make use of the get_list method in the
-            # AWSQueryConnection. Let's do the work manually
-            replication_groups = response['DescribeReplicationGroupsResponse']['DescribeReplicationGroupsResult']['ReplicationGroups']
+        # Cluster ID to the replication group it is a member of
+        replication_group_ids = {}
+        for replication_group in replication_groups:
+            for cluster_id in replication_group.get('MemberClusters') or []:
+                replication_group_ids[cluster_id] = replication_group['ReplicationGroupId']
 
-        except KeyError as e:
-            error = "ElastiCache [Replication Groups] query to AWS failed (unexpected format)."
-            self.fail_with_error(error, 'getting ElastiCache clusters')
+        for cluster in clusters:
+            self.add_elasticache_cluster(cluster, region,
+                                         replication_group_ids.get(cluster['CacheClusterId']))
 
         for replication_group in replication_groups:
             self.add_elasticache_replication_group(replication_group, region)
@@ -798,12 +3200,23 @@ class Ec2Inventory(object):
         sys.exit(1)
 
     def get_instance(self, region, instance_id):
-        conn = self.connect(region)
+        ''' Looks the instance up in each account that queries region '''
 
-        reservations = conn.get_all_instances([instance_id])
-        for reservation in reservations:
-            for instance in reservation.instances:
-                return instance
+        self.called_aws = True
+        for account in self.get_accounts():
+            if account['regions'] and region not in account['regions']:
+                continue
+            conn = self.connect(region, account)
+
+            if self.accounts:
+                # Asking for an ID by name fails in the accounts that don't
+                # own it, so filter on it instead
+                reservations = conn.get_all_instances(filters={'instance-id': instance_id})
+            else:
+                reservations = conn.get_all_instances([instance_id])
+            for reservation in reservations:
+                for instance in reservation.instances:
+                    return instance
 
     def add_instance(self, instance, region):
         ''' Adds an instance to the inventory and index, as long as it is
@@ -1075,9 +3488,10 @@ class Ec2Inventory(object):
         self.inventory["_meta"]["hostvars"][hostname] = self.get_host_info_dict_from_instance(instance)
         self.inventory["_meta"]["hostvars"][hostname]['ansible_ssh_host'] = dest
 
-    def add_elasticache_cluster(self, cluster, region):
+    def add_elasticache_cluster(self, cluster, region, replication_group_id=None):
         ''' Adds an ElastiCache cluster to the inventory and index, as long as
-        it's nodes are addressable '''
+        it's nodes are addressable. replication_group_id is used when the
+        cluster description doesn't name its replication group. '''
 
         # Only want available clusters unless all_elasticache_clusters is True
         if not self.all_elasticache_clusters and cluster['CacheClusterStatus'] != 'available':
@@ -1158,10 +3572,11 @@ class Ec2Inventory(object):
                 self.push_group(self.inventory, 'elasticache_parameter_groups', self.to_safe(cluster['CacheParameterGroup']['CacheParameterGroupName']))
 
         # Inventory: Group by replication group
-        if self.group_by_elasticache_replication_group and 'ReplicationGroupId' in cluster and cluster['ReplicationGroupId']:
-            self.push(self.inventory, self.to_safe("elasticache_replication_group_" + cluster['ReplicationGroupId']), dest)
+        replication_group_id = cluster.get('ReplicationGroupId') or replication_group_id
+        if self.group_by_elasticache_replication_group and replication_group_id:
+            self.push(self.inventory, self.to_safe("elasticache_replication_group_" + replication_group_id), dest)
             if self.nested_groups:
-                self.push_group(self.inventory, 'elasticache_replication_groups', self.to_safe(cluster['ReplicationGroupId']))
+                self.push_group(self.inventory, 'elasticache_replication_groups', self.to_safe(replication_group_id))
 
         # Global Tag: all ElastiCache clusters
         self.push(self.inventory, 'elasticache_clusters', cluster['CacheClusterId'])
@@ -1314,39 +3729,92 @@ class Ec2Inventory(object):
 
         self.inventory["_meta"]["hostvars"][dest] = host_info
 
-    def get_route53_records(self):
-        ''' Get and store the map of resource records to domain names that
-        point to them. '''
+    def fetch_route53_records(self):
+        ''' Get the map of resource records to domain names that point to
+        them. Records are cached per hosted zone; a zone is only fetched again
+        when its cached records are older than route53_cache_max_age or its
+        record set count has changed. '''
 
         if self.boto_profile:
+            from boto import route53
             r53_conn = route53.Route53Connection(profile_name=self.boto_profile)
         else:
+            from boto import route53
             r53_conn = route53.Route53Connection()
         all_zones = r53_conn.get_zones()
 
         route53_zones = [ zone for zone in all_zones if zone.name[:-1]
                           not in self.route53_excluded_zones ]
 
-        self.route53_records = {}
-
+        cached_zones = self.load_route53_cache()
+        now = time()
+        zones = {}
+        stale_zones = []
         for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+            record_count = getattr(zone, 'resourcerecordsetcount', None)
+            cached = cached_zones.get(zone.id)
+            if cached and cached['count'] == record_count and \
+               cached['fetched'] + self.route53_cache_max_age > now:
+                zones[zone.id] = cached
+            else:
+                stale_zones.append(zone)
 
-            for record_set in rrsets:
+        def fetch_zone(zone):
+            zone_records = {}
+            for record_set in r53_conn.get_all_rrsets(zone.id):
                 record_name = record_set.name
 
                 if record_name.endswith('.'):
                     record_name = record_name[:-1]
 
                 for resource in record_set.resource_records:
-                    self.route53_records.setdefault(resource, set())
-                    self.route53_records[resource].add(record_name)
+                    zone_records.setdefault(resource, set())
+                    zone_records[resource].add(record_name)
+
+            return {'count': getattr(zone, 'resourcerecordsetcount', None), 'fetched': now,
+                    'records': dict((k, sorted(v)) for k, v in zone_records.items())}
+
+        for zone, zone_cache in zip(stale_zones, self.map_concurrently(fetch_zone, stale_zones)):
+            zones[zone.id] = zone_cache
+
+        if stale_zones or len(zones) != len(cached_zones):
+            self.write_to_cache({'zones': zones}, 'route53')
 
+        return self.merge_route53_zones(zones)
+
+    def merge_route53_zones(self, zones):
+        ''' Merges the per-zone records into one map of resource records to
+        domain names '''
+
+        route53_records = {}
+        for zone_id in sorted(zones):
+            for resource, names in zones[zone_id]['records'].items():
+                route53_records.setdefault(resource, set()).update(names)
+
+        return route53_records
+
+    def add_route53_records(self, route53_records):
+        ''' Store the map of resource records fetched from Route53 '''
+
+        self.route53_records = dict((k, sorted(v)) for k, v in route53_records.items())
+        self.route53_names_by_instance = {}
+
+    def load_route53_cache(self):
+        ''' Reads the per-zone Route53 records from the cache file '''
+
+        try:
+            return json.loads(self.read_cache_file('route53'))['zones']
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
 
     def get_instance_route53_names(self, instance):
         ''' Check if an instance is referenced in the records we have from
-        Route53. If it is, return the list of domain names pointing to said
-        instance. If nothing points to it, return an empty list. '''
+        Route53. If it is, return the sorted list of domain names pointing to
+        said instance. If nothing points to it, return an empty list. '''
+
+        names = self.route53_names_by_instance.get(instance.id)
+        if names is not None:
+            return names
 
         instance_attributes = [ 'public_dns_name', 'private_dns_name',
                                 'ip_address', 'private_ip_address' ]
@@ -1362,61 +3830,175 @@ class Ec2Inventory(object):
             if value in self.route53_records:
                 name_list.update(self.route53_records[value])
 
-        return list(name_list)
+        names = self.route53_names_by_instance[instance.id] = sorted(name_list)
+        return names
+
+    # How get_host_info_dict_from_instance converts the instance attributes
+    # that aren't booleans, integers, strings or None, by hostvar name, and
+    # the hostvars each handler sets (None if that depends on the value). The
+    # state properties are converted whatever their value.
+    # state/previous_state changed to properties in boto in https://github.com/boto/boto/commit/a23c379837f698212252720d2af8dec0325c9518
+    instance_state_handlers = {
+        'ec2__state': ('project_instance_state', ('ec2_state', 'ec2_state_code')),
+        'ec2__previous_state': ('project_instance_previous_state', ('ec2_previous_state', 'ec2_previous_state_code')),
+    }
+    instance_value_handlers = {
+        'ec2_region': ('project_instance_region', ('ec2_region',)),
+        'ec2__placement': ('project_instance_placement', ('ec2_placement',)),
+        'ec2_tags': ('project_instance_tags', None),
+        'ec2_groups': ('project_instance_groups', ('ec2_security_group_ids', 'ec2_security_group_names')),
+        'ec2_block_device_mapping': ('project_instance_block_devices', ('ec2_block_devices',)),
+    }
+
+    # Same for get_host_info_dict_from_describe_dict. These handlers return
+    # whether they stored the value; if not, it is stored as a plain value.
+    describe_value_handlers = {
+        'ec2_configuration_endpoint': ('project_configuration_endpoint',
+                                       ('ec2_configuration_endpoint_address', 'ec2_configuration_endpoint_port')),
+        'ec2_endpoint': ('project_endpoint', ('ec2_endpoint_address', 'ec2_endpoint_port')),
+        'ec2_node_groups': ('project_node_groups', None),
+        'ec2_member_clusters': ('project_member_clusters', ('ec2_member_clusters',)),
+        'ec2_cache_parameter_group': ('project_cache_parameter_group',
+                                      ('ec2_cache_node_ids_to_reboot', 'ec2_cache_parameter_group_name',
+                                       'ec2_cache_parameter_apply_status')),
+        'ec2_security_groups': ('project_security_groups', ('ec2_security_group_ids',)),
+    }
+
+    def wants_hostvar(self, name):
+        ''' Returns whether hostvars_include and hostvars_exclude let the
+        hostvar name through '''
+
+        wanted = self.hostvars_wanted.get(name)
+        if wanted is None:
+            wanted = not self.filter_hostvars or (
+                (not self.hostvars_include or any(p.match(name) for p in self.hostvars_include))
+                and not any(p.match(name) for p in self.hostvars_exclude))
+            self.hostvars_wanted[name] = wanted
+        return wanted
+
+    def get_hostvar_handler(self, handler, outputs, keep_unwanted=False):
+        ''' Returns the method named handler, or None if none of the hostvars
+        it sets are wanted (unless keep_unwanted). When only some of them are,
+        or they depend on the value, the method is wrapped to drop the others
+        from what it sets. '''
+
+        method = getattr(self, handler)
+        if not self.filter_hostvars:
+            return method
+        if outputs is not None:
+            wanted = [name for name in outputs if self.wants_hostvar(name)]
+            if len(wanted) == len(outputs):
+                return method
+            if not wanted and not keep_unwanted:
+                return None
+
+        def filtered(host_info, *args):
+            produced = {}
+            result = method(produced, *args)
+            for name, value in produced.items():
+                if self.wants_hostvar(name):
+                    host_info[name] = value
+            return result
+        return filtered
+
+    def get_instance_projection(self, attribute):
+        ''' Returns the hostvar name of an instance attribute, the handler
+        for its state property (if it is one), and the handler for values
+        that aren't booleans, integers, strings or None. Names and handlers
+        that would only set unwanted hostvars are None. Worked out once per
+        attribute. '''
+
+        projection = self.hostvar_projections.get(('instance', attribute))
+        if projection is None:
+            key = self.to_safe('ec2_' + attribute)
+            state_handler = value_handler = None
+            if key in self.instance_state_handlers:
+                state_handler = self.get_hostvar_handler(*self.instance_state_handlers[key])
+                key = None
+            elif key in self.instance_value_handlers:
+                value_handler = self.get_hostvar_handler(*self.instance_value_handlers[key])
+            if key is not None and not self.wants_hostvar(key):
+                key = None
+            projection = self.hostvar_projections[('instance', attribute)] = (
+                key, state_handler, value_handler)
+        return projection
+
+    def get_describe_projection(self, describe_key):
+        ''' Returns the hostvar name of a key of an API response, or None if
+        that hostvar isn't wanted, and the handler to try first for its value.
+        Worked out once per key. '''
+
+        projection = self.hostvar_projections.get(('describe', describe_key))
+        if projection is None:
+            key = self.to_safe('ec2_' + self.uncammelize(describe_key))
+            handler = None
+            if key in self.describe_value_handlers:
+                # Kept even when it sets nothing wanted, since what it returns
+                # decides whether the value is stored as a plain value
+                handler = self.get_hostvar_handler(*self.describe_value_handlers[key], keep_unwanted=True)
+            if not self.wants_hostvar(key):
+                key = None
+            projection = self.hostvar_projections[('describe', describe_key)] = (
+                key, handler)
+        return projection
 
     def get_host_info_dict_from_instance(self, instance):
         instance_vars = {}
-        for key in vars(instance):
-            value = getattr(instance, key)
-            key = self.to_safe('ec2_' + key)
-
-            # Handle complex types
-            # state/previous_state changed to properties in boto in https://github.com/boto/boto/commit/a23c379837f698212252720d2af8dec0325c9518
-            if key == 'ec2__state':
-                instance_vars['ec2_state'] = instance.state or ''
-                instance_vars['ec2_state_code'] = instance.state_code
-            elif key == 'ec2__previous_state':
-                instance_vars['ec2_previous_state'] = instance.previous_state or ''
-                instance_vars['ec2_previous_state_code'] = instance.previous_state_code
-            elif type(value) in [int, bool]:
-                instance_vars[key] = value
-            elif isinstance(value, six.string_types):
-                instance_vars[key] = value.strip()
-            elif value is None:
-                instance_vars[key] = ''
-            elif key == 'ec2_region':
-                instance_vars[key] = value.name
-            elif key == 'ec2__placement':
-                instance_vars['ec2_placement'] = value.zone
-            elif key == 'ec2_tags':
-                for k, v in value.items():
-                    if self.expand_csv_tags and ',' in v:
-                        v = list(map(lambda x: x.strip(), v.split(',')))
-                    key = self.to_safe('ec2_tag_' + k)
-                    instance_vars[key] = v
-            elif key == 'ec2_groups':
-                group_ids = []
-                group_names = []
-                for group in value:
-                    group_ids.append(group.id)
-                    group_names.append(group.name)
-                instance_vars["ec2_security_group_ids"] = ','.join([str(i) for i in group_ids])
-                instance_vars["ec2_security_group_names"] = ','.join([str(i) for i in group_names])
-            elif key == 'ec2_block_device_mapping':
-                instance_vars["ec2_block_devices"] = {}
-                for k, v in value.items():
-                    instance_vars["ec2_block_devices"][ os.path.basename(k) ] = v.volume_id
-            else:
-                pass
-                # TODO Product codes if someone finds them useful
-                #print key
-                #print type(value)
-                #print value
+        for attribute in vars(instance):
+            key, state_handler, value_handler = self.get_instance_projection(attribute)
+            if state_handler is not None:
+                state_handler(instance_vars, instance)
+                continue
+            if key is None and value_handler is None:
+                # Not wanted, see hostvars_include and hostvars_exclude
+                continue
+            value = getattr(instance, attribute)
+            if not project_scalar(instance_vars, key, value) and value_handler is not None:
+                value_handler(instance_vars, value)
+            # TODO Product codes if someone finds them useful
 
-        instance_vars[self.to_safe('ec2_account_id')] = self.aws_account_id
+        if self.wants_hostvar('ec2_account_id'):
+            instance_vars['ec2_account_id'] = self.aws_account_id
 
         return instance_vars
 
+    def project_instance_state(self, instance_vars, instance):
+        instance_vars['ec2_state'] = instance.state or ''
+        instance_vars['ec2_state_code'] = instance.state_code
+
+    def project_instance_previous_state(self, instance_vars, instance):
+        instance_vars['ec2_previous_state'] = instance.previous_state or ''
+        instance_vars['ec2_previous_state_code'] = instance.previous_state_code
+
+    def project_instance_region(self, instance_vars, value):
+        instance_vars['ec2_region'] = value.name
+
+    def project_instance_placement(self, instance_vars, value):
+        instance_vars['ec2_placement'] = value.zone
+
+    def project_instance_tags(self, instance_vars, value):
+        for k, v in value.items():
+            key = self.to_safe('ec2_tag_' + k)
+            if not self.wants_hostvar(key):
+                continue
+            if self.expand_csv_tags and ',' in v:
+                v = list(map(lambda x: x.strip(), v.split(',')))
+            instance_vars[key] = v
+
+    def project_instance_groups(self, instance_vars, value):
+        group_ids = []
+        group_names = []
+        for group in value:
+            group_ids.append(group.id)
+            group_names.append(group.name)
+        instance_vars["ec2_security_group_ids"] = ','.join([str(i) for i in group_ids])
+        instance_vars["ec2_security_group_names"] = ','.join([str(i) for i in group_names])
+
+    def project_instance_block_devices(self, instance_vars, value):
+        instance_vars["ec2_block_devices"] = {}
+        for k, v in value.items():
+            instance_vars["ec2_block_devices"][ os.path.basename(k) ] = v.volume_id
+
     def get_host_info_dict_from_describe_dict(self, describe_dict):
         ''' Parses the dictionary returned by the API call into a flat list
             of parameters. This method should be used only when 'describe' is
@@ -1428,98 +4010,275 @@ class Ec2Inventory(object):
         # compatibility.
 
         host_info = {}
-        for key in describe_dict:
-            value = describe_dict[key]
-            key = self.to_safe('ec2_' + self.uncammelize(key))
-
-            # Handle complex types
-
-            # Target: Memcached Cache Clusters
-            if key == 'ec2_configuration_endpoint' and value:
-                host_info['ec2_configuration_endpoint_address'] = value['Address']
-                host_info['ec2_configuration_endpoint_port'] = value['Port']
-
-            # Target: Cache Nodes and Redis Cache Clusters (single node)
-            if key == 'ec2_endpoint' and value:
-                host_info['ec2_endpoint_address'] = value['Address']
-                host_info['ec2_endpoint_port'] = value['Port']
-
-            # Target: Redis Replication Groups
-            if key == 'ec2_node_groups' and value:
-                host_info['ec2_endpoint_address'] = value[0]['PrimaryEndpoint']['Address']
-                host_info['ec2_endpoint_port'] = value[0]['PrimaryEndpoint']['Port']
-                replica_count = 0
-                for node in value[0]['NodeGroupMembers']:
-                    if node['CurrentRole'] == 'primary':
-                        host_info['ec2_primary_cluster_address'] = node['ReadEndpoint']['Address']
-                        host_info['ec2_primary_cluster_port'] = node['ReadEndpoint']['Port']
-                        host_info['ec2_primary_cluster_id'] = node['CacheClusterId']
-                    elif node['CurrentRole'] == 'replica':
-                        host_info['ec2_replica_cluster_address_'+ str(replica_count)] = node['ReadEndpoint']['Address']
-                        host_info['ec2_replica_cluster_port_'+ str(replica_count)] = node['ReadEndpoint']['Port']
-                        host_info['ec2_replica_cluster_id_'+ str(replica_count)] = node['CacheClusterId']
-                        replica_count += 1
-
-            # Target: Redis Replication Groups
-            if key == 'ec2_member_clusters' and value:
-                host_info['ec2_member_clusters'] = ','.join([str(i) for i in value])
-
-            # Target: All Cache Clusters
-            elif key == 'ec2_cache_parameter_group':
-                host_info["ec2_cache_node_ids_to_reboot"] = ','.join([str(i) for i in value['CacheNodeIdsToReboot']])
-                host_info['ec2_cache_parameter_group_name'] = value['CacheParameterGroupName']
-                host_info['ec2_cache_parameter_apply_status'] = value['ParameterApplyStatus']
-
-            # Target: Almost everything
-            elif key == 'ec2_security_groups':
-
-                # Skip if SecurityGroups is None
-                # (it is possible to have the key defined but no value in it).
-                if value is not None:
-                    sg_ids = []
-                    for sg in value:
-                        sg_ids.append(sg['SecurityGroupId'])
-                    host_info["ec2_security_group_ids"] = ','.join([str(i) for i in sg_ids])
-
-            # Target: Everything
-            # Preserve booleans and integers
-            elif type(value) in [int, bool]:
-                host_info[key] = value
-
-            # Target: Everything
-            # Sanitize string values
-            elif isinstance(value, six.string_types):
-                host_info[key] = value.strip()
-
-            # Target: Everything
-            # Replace None by an empty string
-            elif value is None:
-                host_info[key] = ''
-
-            else:
-                # Remove non-processed complex types
-                pass
+        for describe_key, value in describe_dict.items():
+            key, handler = self.get_describe_projection(describe_key)
+            if handler is None or not handler(host_info, value):
+                # Preserve booleans and integers, sanitize strings, replace
+                # None by an empty string and remove non-processed complex
+                # types
+                project_scalar(host_info, key, value)
 
         return host_info
 
+    # Target: Memcached Cache Clusters
+    def project_configuration_endpoint(self, host_info, value):
+        if value:
+            host_info['ec2_configuration_endpoint_address'] = value['Address']
+            host_info['ec2_configuration_endpoint_port'] = value['Port']
+        return False
+
+    # Target: Cache Nodes and Redis Cache Clusters (single node)
+    def project_endpoint(self, host_info, value):
+        if value:
+            host_info['ec2_endpoint_address'] = value['Address']
+            host_info['ec2_endpoint_port'] = value['Port']
+        return False
+
+    # Target: Redis Replication Groups
+    def project_node_groups(self, host_info, value):
+        if value:
+            host_info['ec2_endpoint_address'] = value[0]['PrimaryEndpoint']['Address']
+            host_info['ec2_endpoint_port'] = value[0]['PrimaryEndpoint']['Port']
+            replica_count = 0
+            for node in value[0]['NodeGroupMembers']:
+                if node['CurrentRole'] == 'primary':
+                    host_info['ec2_primary_cluster_address'] = node['ReadEndpoint']['Address']
+                    host_info['ec2_primary_cluster_port'] = node['ReadEndpoint']['Port']
+                    host_info['ec2_primary_cluster_id'] = node['CacheClusterId']
+                elif node['CurrentRole'] == 'replica':
+                    host_info['ec2_replica_cluster_address_'+ str(replica_count)] = node['ReadEndpoint']['Address']
+                    host_info['ec2_replica_cluster_port_'+ str(replica_count)] = node['ReadEndpoint']['Port']
+                    host_info['ec2_replica_cluster_id_'+ str(replica_count)] = node['CacheClusterId']
+                    replica_count += 1
+        return False
+
+    # Target: Redis Replication Groups
+    def project_member_clusters(self, host_info, value):
+        if value:
+            host_info['ec2_member_clusters'] = ','.join([str(i) for i in value])
+            return True
+        return False
+
+    # Target: All Cache Clusters
+    def project_cache_parameter_group(self, host_info, value):
+        host_info["ec2_cache_node_ids_to_reboot"] = ','.join([str(i) for i in value['CacheNodeIdsToReboot']])
+        host_info['ec2_cache_parameter_group_name'] = value['CacheParameterGroupName']
+        host_info['ec2_cache_parameter_apply_status'] = value['ParameterApplyStatus']
+        return True
+
+    # Target: Almost everything
+    def project_security_groups(self, host_info, value):
+        # Skip if SecurityGroups is None
+        # (it is possible to have the key defined but no value in it).
+        if value is not None:
+            sg_ids = []
+            for sg in value:
+                sg_ids.append(sg['SecurityGroupId'])
+            host_info["ec2_security_group_ids"] = ','.join([str(i) for i in sg_ids])
+        return True
+
     def get_host_info(self):
         ''' Get variables about a specific host '''
 
+        # Answer from the cached hostvars when we can
+        host_info = self.get_host_info_from_host_index(self.args.host)
+        if host_info is not None:
+            return self.json_format_dict(host_info, self.pretty_json)
+
         if len(self.index) == 0:
             # Need to load index from cache
             self.load_index_from_cache()
 
         if not self.args.host in self.index:
-            # try updating the cache
-            self.do_api_calls_update_cache()
+            # try to find just this host, and add it to the cache
+            self.fetch_host_update_cache(self.args.host)
+            host_info = self.get_host_info_from_host_index(self.args.host)
+            if host_info is not None:
+                return self.json_format_dict(host_info, self.pretty_json)
+
+            if not self.args.host in self.index and (self.route53_hostnames or self.destination_format):
+                # names built from Route53 or destination_format can't be
+                # searched for, so fall back to updating the whole cache
+                self.do_api_calls_update_cache(use_snapshots=False)
+
             if not self.args.host in self.index:
                 # host might not exist anymore
-                return self.json_format_dict({}, True)
+                return self.json_format_dict({}, self.pretty_json)
 
         (region, instance_id) = self.index[self.args.host]
 
         instance = self.get_instance(region, instance_id)
-        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
+        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), self.pretty_json)
+
+    def get_host_filters(self, host):
+        ''' Returns the EC2 filters that may find the instance named host, in
+        the order they should be tried '''
+
+        if re.match(r'^i-[0-9a-f]+$', host):
+            return [{'instance-id': [host]}]
+        if re.match(r'^\d{1,3}(\.\d{1,3}){3}$', host):
+            return [{'private-ip-address': [host]}, {'ip-address': [host]}]
+        if host.endswith('.internal'):
+            return [{'private-dns-name': [host]}]
+        if host.endswith('.amazonaws.com'):
+            return [{'dns-name': [host]}]
+
+        tag_name = 'Name'
+        if self.hostname_variable and self.hostname_variable.startswith('tag_'):
+            tag_name = self.hostname_variable[4:]
+        return [{'tag:' + tag_name: [host]}]
+
+    def fetch_host_update_cache(self, host):
+        ''' Looks for the instance named host in every region of every
+        account, and merges whatever is found into the existing cache files.
+        The merged cache keeps the date of the cache it was merged into, so
+        that it still expires on time. If that cache has expired in the
+        meantime, the whole cache is refreshed instead. '''
+
+        self.called_aws = True
+        account_regions = self.get_account_regions()
+        for host_filter in self.get_host_filters(host):
+            found = self.map_concurrently(
+                lambda pair: list(self.fetch_instances_by_region(pair[1], pair[0], host_filter)), account_regions)
+            if any(found):
+                break
+        else:
+            return
+
+        with self.cache_lock():
+            age = self.cache_backend.age('cache')
+            merged = age is not None and self.is_cache_valid(self.get_inventory_max_age() + self.cache_stale_while_revalidate)
+            if merged:
+                self.merge_hosts_into_cache(account_regions, found, time() - age)
+        if not merged:
+            # Merging into an empty inventory would publish only these hosts
+            self.update_cache()
+
+    def merge_hosts_into_cache(self, account_regions, found, published):
+        ''' Adds the reservations found for each (account, region) pair to the
+        cached inventory, and publishes the result dated published '''
+
+        self.inventory = unhoist_group_vars(json.loads(self.get_inventory_from_cache()))
+        self.load_index_from_cache()
+        if self.route53_enabled:
+            self.add_route53_records(self.merge_route53_zones(self.load_route53_cache()))
+
+        known_ids = set(instance_id for region, instance_id in self.index.values())
+        for (account, region), reservations in zip(account_regions, found):
+            for reservation in reservations:
+                reservation.instances = [i for i in reservation.instances if i.id not in known_ids]
+            if account['name'] is not None:
+                self.add_for_account(account, partial(self.add_instances_by_region, region), reservations)
+            else:
+                self.add_instances_by_region(region, reservations)
+
+        self.write_caches(published)
+
+    def write_host_index(self, all_hostvars, index, generation):
+        ''' Writes the hostvars to an SQLite database next to the cache, keyed
+        by inventory hostname, instance ID, private IP address and Name tag,
+        so that --host can be answered without loading the whole cache.
+        generation identifies the inventory the hostvars come from. '''
+
+        if not HAS_SQLITE:
+            return
+
+        host_keys = self.get_host_keys(all_hostvars, index)
+
+        tmp_path = '%s.%d.tmp' % (self.cache_path_host_index, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        db = sqlite3.connect(tmp_path)
+        try:
+            db.execute('CREATE TABLE hosts (hostname TEXT PRIMARY KEY, hostvars TEXT)')
+            db.execute('CREATE TABLE host_keys (key TEXT PRIMARY KEY, hostname TEXT)')
+            db.execute('CREATE TABLE generation (generation TEXT)')
+            db.execute('INSERT INTO generation VALUES (?)', (generation,))
+            db.executemany('INSERT INTO hosts VALUES (?, ?)',
+                           [(hostname, self.json_format_dict(hostvars))
+                            for hostname, hostvars in all_hostvars.items()])
+            db.executemany('INSERT OR IGNORE INTO host_keys VALUES (?, ?)',
+                           [(key, hostname) for key, hostname, priority in host_keys])
+            db.commit()
+        finally:
+            db.close()
+        os.rename(tmp_path, self.cache_path_host_index)
+
+    def get_host_keys(self, all_hostvars, index):
+        ''' Returns the (key, hostname, priority) tuples --host can find a
+        host by, in priority order: when keys collide, hostnames win over
+        instance IDs, then private IP addresses, then Name tags '''
+
+        host_keys = []
+        for hostname, (region, instance_id) in sorted(index.items()):
+            hostvars = all_hostvars.get(hostname)
+            if hostvars is None:
+                continue
+            host_keys.append((hostname, hostname, 0))
+            host_keys.append((instance_id, hostname, 1))
+            if hostvars.get('ec2_private_ip_address'):
+                host_keys.append((hostvars['ec2_private_ip_address'], hostname, 2))
+            if hostvars.get('ec2_tag_Name'):
+                host_keys.append((hostvars['ec2_tag_Name'], hostname, 3))
+
+        host_keys.sort(key=lambda k: k[2])
+        return host_keys
+
+    def get_host_info_from_host_index(self, host):
+        ''' Looks host up in the host index written by write_host_index.
+        Returns its hostvars, or None if it isn't there. The index is local
+        to this machine; when the cache backend holds an inventory it wasn't
+        built from (e.g. one published by another machine), it is rebuilt
+        from that inventory first. '''
+
+        if not HAS_SQLITE:
+            return None
+
+        generation = self.cache_backend.get('generation')
+        if generation is None:
+            return None
+        generation = generation.decode('ascii')
+
+        if self.get_host_index_generation() != generation:
+            try:
+                hostvars = unhoist_group_vars(json.loads(self.get_inventory_from_cache()))['_meta']['hostvars']
+                index = json.loads(self.read_cache_file('index'))
+            except (IOError, OSError, ValueError, KeyError):
+                return None
+            self.write_host_index(hostvars, index, generation)
+
+        try:
+            db = sqlite3.connect(self.cache_path_host_index)
+            try:
+                row = db.execute('SELECT hosts.hostvars FROM host_keys JOIN hosts'
+                                 ' ON hosts.hostname = host_keys.hostname WHERE host_keys.key = ?',
+                                 (host,)).fetchone()
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return None
+
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_host_index_generation(self):
+        ''' Returns the generation of the inventory the host index was built
+        from, or None if there is no usable host index '''
+
+        if not os.path.isfile(self.cache_path_host_index):
+            return None
+
+        try:
+            db = sqlite3.connect(self.cache_path_host_index)
+            try:
+                row = db.execute('SELECT generation FROM generation').fetchone()
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return None
+
+        return row[0] if row else None
 
     def push(self, my_dict, key, element):
         ''' Push an element onto an array that may not have been defined in
@@ -1536,52 +4295,118 @@ class Ec2Inventory(object):
         parent_group = my_dict.setdefault(key, {})
         if not isinstance(parent_group, dict):
             parent_group = my_dict[key] = {'hosts': parent_group}
-        child_groups = parent_group.setdefault('children', [])
-        if element not in child_groups:
-            child_groups.append(element)
+        child_groups = parent_group.get('children')
+        if not isinstance(child_groups, GroupChildren):
+            # New, or a plain list read back from the cache
+            child_groups = parent_group['children'] = GroupChildren(child_groups or ())
+        child_groups.add(element)
 
     def get_inventory_from_cache(self):
-        ''' Reads the inventory from the cache file and returns it as a JSON
+        ''' Reads the inventory from the cache and returns it as a JSON
         object '''
 
-        with open(self.cache_path_cache, 'r') as f:
-            json_inventory = f.read()
-            return json_inventory
+        return self.read_cache_file('cache')
+
+    def print_inventory_from_cache(self):
+        ''' Copies the cached inventory to stdout as it is stored, without
+        decoding it '''
+
+        f = self.cache_backend.open('cache')
+        if f is None:
+            # Expired since is_cache_valid was checked; the refreshed
+            # inventory is printed as it is written
+            self.inventory_out = getattr(sys.stdout, 'buffer', sys.stdout)
+            self.do_api_calls_update_cache()
+            return
+
+        sys.stdout.flush()
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        with f:
+            if f.read(2) == GZIP_MAGIC:
+                f.seek(0)
+                shutil.copyfileobj(gzip.GzipFile(fileobj=f, mode='rb'), out, COPY_BUFFER_SIZE)
+            else:
+                f.seek(0)
+                if not self.sendfile(f, out):
+                    shutil.copyfileobj(f, out, COPY_BUFFER_SIZE)
+        out.write(b'\n')
+        out.flush()
+
+    def sendfile(self, source, out):
+        ''' Copies the file source to out with os.sendfile. Returns False if
+        out isn't a file descriptor sendfile can write to. '''
+
+        if not hasattr(os, 'sendfile'):
+            return False
+        try:
+            out.flush()
+            out_fd = out.fileno()
+            source_fd = source.fileno()
+        except (AttributeError, ValueError, IOError, OSError):
+            return False
+
+        offset = 0
+        size = os.fstat(source_fd).st_size
+        while offset < size:
+            try:
+                sent = os.sendfile(out_fd, source_fd, offset, size - offset)
+            except OSError:
+                if offset == 0:
+                    return False
+                raise
+            if sent == 0:
+                break
+            offset += sent
+        return True
 
     def load_index_from_cache(self):
-        ''' Reads the index from the cache file sets self.index '''
+        ''' Reads the index from the cache sets self.index '''
 
-        with open(self.cache_path_index, 'rb') as f:
-            self.index = json.load(f)
+        self.index = json.loads(self.read_cache_file('index'))
 
-    def write_to_cache(self, data, filename):
-        ''' Writes data in JSON format to a file '''
+    def read_cache_file(self, key):
+        ''' Returns the text of a cache entry, decompressing it if needed.
+        Raises IOError if the entry is missing or has expired. '''
 
-        json_data = self.json_format_dict(data, True)
-        with open(filename, 'w') as f:
-            f.write(json_data)
+        data = self.cache_backend.get(key)
+        if data is None:
+            raise IOError("no unexpired '%s' entry in the cache" % key)
+        if data[:2] == GZIP_MAGIC:
+            data = gzip.GzipFile(fileobj=io.BytesIO(data), mode='rb').read()
+        return data.decode('utf-8')
+
+    def write_to_cache(self, data, key, ttl=None):
+        ''' Publishes data in compact JSON format to the cache, expiring after
+        ttl seconds if given '''
+
+        self.cache_backend.publish([(key, self.encode_cache_entry(self.json_format_dict(data)), ttl)])
+
+    def encode_cache_entry(self, text):
+        ''' Returns text as the bytes to store in the cache, compressed if
+        cache_compression is set '''
+
+        data = text.encode('utf-8')
+        if self.cache_compression == 'gzip':
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0) as gz:
+                gz.write(data)
+            data = buf.getvalue()
+        return data
 
     def uncammelize(self, key):
-        temp = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', key)
-        return re.sub('([a-z0-9])([A-Z])', r'\1_\2', temp).lower()
+        return uncammelize(key)
 
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be used as Ansible groups '''
-        regex = "[^A-Za-z0-9\_"
-        if not self.replace_dash_in_groups:
-            regex += "\-"
-        return re.sub(regex + "]", "_", word)
+        return to_safe(word, self.replace_dash_in_groups)
 
     def json_format_dict(self, data, pretty=False):
         ''' Converts a dict to a JSON object and dumps it as a formatted
         string '''
 
-        if pretty:
-            return json.dumps(data, sort_keys=True, indent=2)
-        else:
-            return json.dumps(data)
+        return dumps_json(data, pretty)
 
 
 if __name__ == '__main__':
     # Run the script
-    Ec2Inventory()
+    check_startup_budget(Ec2Inventory().called_aws)
@@ -0,0 +1,164 @@
+''' Helpers shared by the tests of the ec2.py dynamic inventory: loading the
+script as a module, a stand-in for the boto EC2 connection, and ini files
+pointing at a temporary cache '''
+
+import contextlib
+import importlib.util
+import io
+import os
+import re
+import sys
+
+EC2_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ec2.py')
+
+INI = '''[ec2]
+regions = us-east-1
+destination_variable = public_dns_name
+vpc_destination_variable = private_ip_address
+route53 = False
+rds = False
+elasticache = False
+cache_path = %(cache_path)s
+cache_max_age = 300
+'''
+
+
+def load_ec2_module():
+    ''' Loads a fresh copy of ec2.py, so that patching its classes doesn't
+    leak into other tests '''
+
+    spec = importlib.util.spec_from_file_location('ec2_inventory', EC2_PY)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_ini(directory, extra='', **settings):
+    ''' Writes an ec2.ini with its cache in directory, plus the lines in
+    extra, and returns its path. settings replace the values of the options
+    of INI by the same name. '''
+
+    text = INI % {'cache_path': os.path.join(directory, 'cache')}
+    for name, value in settings.items():
+        text = re.sub(r'(?m)^%s = .*$' % name, '%s = %s' % (name, value), text)
+    path = os.path.join(directory, 'ec2.ini')
+    with open(path, 'w') as ini:
+        ini.write(text)
+        ini.write(extra)
+    return path
+
+
+def make_reservations(count, region='us-east-1', owner_id='123456789012', first=0):
+    ''' Returns boto reservations of count running VPC instances, three to a
+    reservation, named app-<n> and spread over three roles '''
+
+    from boto.ec2.group import Group
+    from boto.ec2.instance import Instance, InstancePlacement, InstanceState, Reservation
+
+    reservations = []
+    for n in range(first, first + count):
+        if (n - first) % 3 == 0:
+            reservation = Reservation()
+            reservation.owner_id = owner_id
+            reservation.instances = []
+            reservations.append(reservation)
+        instance = Instance()
+        instance.id = 'i-%08x' % n
+        instance._state = InstanceState(16, 'running')
+        instance._placement = InstancePlacement()
+        instance._placement.zone = region + 'abc'[n % 3]
+        instance.vpc_id = 'vpc-%d' % (n % 2)
+        instance.subnet_id = 'subnet-%d' % (n % 6)
+        instance.private_ip_address = '10.%d.%d.%d' % (n // 62500, n // 250 % 250, n % 250)
+        instance.private_dns_name = 'ip-%d.ec2.internal' % n
+        instance.image_id = 'ami-%d' % (n % 4)
+        instance.instance_type = 't3.micro'
+        instance.key_name = 'deploy'
+        group = Group()
+        group.id = 'sg-%d' % (n % 5)
+        group.name = 'app-%d' % (n % 5)
+        instance.groups = [group]
+        instance.tags = {'Name': 'app-%d' % n, 'Environment': 'PROD', 'Role': ('web', 'worker', 'db')[n % 3]}
+        reservation.instances.append(instance)
+    return reservations
+
+
+class FakeEC2Connection(object):
+    ''' Answers get_all_instances and get_all_tags from a list of
+    reservations, and counts the calls '''
+
+    def __init__(self, reservations):
+        self.reservations = reservations
+        self.calls = 0
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        self.calls += 1
+        return self.reservations
+
+    def get_all_tags(self, filters=None):
+        from boto.ec2.tag import Tag
+
+        self.calls += 1
+        instance_ids = set(filters['resource-id'])
+        tags = []
+        for reservation in self.reservations:
+            for instance in reservation.instances:
+                if instance.id in instance_ids:
+                    for name, value in instance.tags.items():
+                        tag = Tag()
+                        tag.res_id, tag.name, tag.value = instance.id, name, value
+                        tags.append(tag)
+        return tags
+
+
+class FakeRDSConnection(object):
+    ''' Answers get_all_dbinstances with no instances '''
+
+    class ResultSet(list):
+        marker = None
+
+    def get_all_dbinstances(self, marker=None):
+        return self.ResultSet()
+
+
+@contextlib.contextmanager
+def script_arguments(ini_path, args):
+    ''' Sets the command line and EC2_INI_PATH the script reads for the
+    duration of the block '''
+
+    saved = sys.argv, os.environ.get('EC2_INI_PATH')
+    sys.argv = [EC2_PY] + list(args)
+    os.environ['EC2_INI_PATH'] = ini_path
+    try:
+        yield
+    finally:
+        sys.argv = saved[0]
+        if saved[1] is None:
+            del os.environ['EC2_INI_PATH']
+        else:
+            os.environ['EC2_INI_PATH'] = saved[1]
+
+
+def run_inventory(module, ini_path, args, connection=None):
+    ''' Runs the inventory of a module from load_ec2_module with args, its
+    EC2 calls answered by connection, and returns what it printed '''
+
+    if connection is not None:
+        module.Ec2Inventory.connect = lambda self, region, account=None: connection
+    out = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+    with script_arguments(ini_path, args), contextlib.redirect_stdout(out):
+        module.Ec2Inventory()
+    out.flush()
+    return out.buffer.getvalue().decode('utf-8')
+
+
+def new_inventory(module, ini_path, args=()):
+    ''' Returns an Ec2Inventory of a module from load_ec2_module that has
+    read its settings, but hasn't done anything else '''
+
+    class Inventory(module.Ec2Inventory):
+        def run(self):
+            pass
+
+    with script_arguments(ini_path, args):
+        return Inventory()
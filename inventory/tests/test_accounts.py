@@ -0,0 +1,73 @@
+''' Each [account:<name>] section gets its own fetch_timeout, counted from
+its own first fetch, so a slow account only makes its own hosts stale '''
+
+import contextlib
+import io
+import shutil
+import tempfile
+import time
+import unittest
+
+from support import FakeEC2Connection, load_ec2_module, make_reservations, new_inventory, write_ini
+
+ACCOUNTS = '''fetch_timeout = 1
+
+[account:slow]
+boto_profile = slow
+
+[account:fast]
+boto_profile = fast
+'''
+
+
+class SlowEC2Connection(FakeEC2Connection):
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        time.sleep(1.5)
+        return FakeEC2Connection.get_all_instances(self, instance_ids, filters)
+
+
+class AccountDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ini_path = write_ini(self.directory, ACCOUNTS)
+        self.module = load_ec2_module()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def refresh(self, connections):
+        ''' Refreshes the cache like --refresh-cache, with connections[account
+        name] answering the EC2 calls of each account, and returns the hosts
+        of the inventory and what was written to stderr '''
+
+        self.module.Ec2Inventory.connect = lambda self, region, account=None: connections[account['name']]
+        inventory = new_inventory(self.module, self.ini_path)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            inventory.do_api_calls_update_cache(use_snapshots=False)
+        return set(inventory.index), err.getvalue()
+
+    def test_slow_account(self):
+        slow = make_reservations(3, owner_id='111111111111')
+        fast = make_reservations(3, owner_id='222222222222', first=100)
+        hosts, err = self.refresh({'slow': FakeEC2Connection(slow), 'fast': FakeEC2Connection(fast)})
+        self.assertEqual(len(hosts), 6)
+
+        # Both accounts gained a host since, but only the fast one is done in
+        # time; it is fetched after the slow one has used up its own timeout
+        slow = make_reservations(4, owner_id='111111111111')
+        fast = make_reservations(4, owner_id='222222222222', first=100)
+        started = time.time()
+        hosts, err = self.refresh({'slow': SlowEC2Connection(slow), 'fast': FakeEC2Connection(fast)})
+        self.assertLess(time.time() - started, 1.5)
+        self.assertIn('not done within fetch_timeout = 1 seconds", while: refreshing account.slow.ec2', err)
+        self.assertNotIn('account.fast', err)
+        self.assertEqual(len(hosts), 7)
+        self.assertIn('10.0.0.103', hosts)
+        self.assertNotIn('10.0.0.3', hosts)
+
+
+if __name__ == '__main__':
+    unittest.main()
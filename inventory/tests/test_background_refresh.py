@@ -0,0 +1,64 @@
+''' Of several runs serving the same expired cache, only one starts a
+background refresh '''
+
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from support import load_ec2_module, new_inventory, write_ini
+
+
+class BackgroundRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ini_path = write_ini(self.directory, 'cache_lock_timeout = 1\n')
+        self.module = load_ec2_module()
+        patcher = mock.patch.object(subprocess, 'Popen')
+        self.popen = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def start(self):
+        new_inventory(self.module, self.ini_path).start_background_refresh()
+        return self.popen.call_count
+
+    def publish_cache(self):
+        new_inventory(self.module, self.ini_path).cache_backend.publish([('cache', b'{}', None)])
+
+    def test_started_once(self):
+        self.publish_cache()
+        self.assertEqual(self.start(), 1)
+        # The first copy hasn't taken the lock yet
+        self.assertEqual(self.start(), 1)
+        self.assertEqual(self.popen.call_args[0][0][-1], '--background-refresh')
+
+    def test_refresh_running(self):
+        refresh = new_inventory(self.module, self.ini_path)
+        with refresh.cache_lock() as locked:
+            self.assertTrue(locked)
+            self.assertEqual(self.start(), 0)
+        self.assertEqual(self.start(), 1)
+
+    def test_refresh_done(self):
+        # The cache published by the refresh makes its marker stale
+        self.assertEqual(self.start(), 1)
+        time.sleep(0.01)
+        self.publish_cache()
+        self.assertEqual(self.start(), 2)
+        self.assertEqual(self.start(), 2)
+
+    def test_marker_expires(self):
+        # A copy that never took the lock doesn't stop refreshes for good
+        self.assertEqual(self.start(), 1)
+        time.sleep(1.1)
+        self.assertEqual(self.start(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+''' instance_fetch_backend = boto3: the inventory it builds from a
+DescribeInstances response, compared with the boto backend's, looking up a
+host that isn't in the cache, and errors raised while it pages through
+describe_instances '''
+
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import xml.sax
+
+from botocore.exceptions import EndpointConnectionError, NoCredentialsError
+
+from support import FakeEC2Connection, load_ec2_module, run_inventory, write_ini
+
+INSTANCE = '''<item>
+  <instanceId>i-%(n)08x</instanceId>
+  <imageId>ami-00000001</imageId>
+  <instanceState><code>16</code><name>running</name></instanceState>
+  <privateDnsName>ip-10-0-0-%(n)d.ec2.internal</privateDnsName>
+  <dnsName>%(dns_name)s</dnsName>
+  %(ip_address)s
+  <reason/>
+  <keyName>deploy</keyName>
+  <amiLaunchIndex>%(n)d</amiLaunchIndex>
+  <productCodes/>
+  <instanceType>m5.large</instanceType>
+  <launchTime>2026-09-01T10:00:00.000Z</launchTime>
+  <placement><availabilityZone>us-east-1a</availabilityZone><groupName/><tenancy>default</tenancy></placement>
+  <monitoring><state>%(monitoring)s</state></monitoring>
+  <subnetId>subnet-00000001</subnetId>
+  <vpcId>vpc-00000001</vpcId>
+  <privateIpAddress>10.0.0.%(n)d</privateIpAddress>
+  <sourceDestCheck>%(source_dest_check)s</sourceDestCheck>
+  <groupSet><item><groupId>sg-00000001</groupId><groupName>app</groupName></item></groupSet>
+  <architecture>x86_64</architecture>
+  <rootDeviceType>ebs</rootDeviceType>
+  <rootDeviceName>/dev/xvda</rootDeviceName>
+  <blockDeviceMapping>
+    <item><deviceName>/dev/xvda</deviceName><ebs><volumeId>vol-%(n)08x</volumeId><status>attached</status>
+    <attachTime>2026-09-01T10:00:01.000Z</attachTime><deleteOnTermination>true</deleteOnTermination></ebs></item>
+  </blockDeviceMapping>
+  <virtualizationType>hvm</virtualizationType>
+  <clientToken/>
+  <tagSet><item><key>Name</key><value>app-%(n)d</value></item><item><key>Role</key><value>web</value></item></tagSet>
+  <hypervisor>xen</hypervisor>
+  <networkInterfaceSet>
+    <item>
+      <networkInterfaceId>eni-%(n)08x</networkInterfaceId>
+      <subnetId>subnet-00000001</subnetId>
+      <vpcId>vpc-00000001</vpcId>
+      <description/>
+      <ownerId>123456789012</ownerId>
+      <status>in-use</status>
+      <macAddress>02:00:00:00:00:%(n)02x</macAddress>
+      <privateIpAddress>10.0.0.%(n)d</privateIpAddress>
+      <sourceDestCheck>%(source_dest_check)s</sourceDestCheck>
+      <groupSet><item><groupId>sg-00000001</groupId><groupName>app</groupName></item></groupSet>
+      <attachment><attachmentId>eni-attach-%(n)08x</attachmentId><deviceIndex>0</deviceIndex><status>attached</status>
+      <attachTime>2026-09-01T10:00:00.000Z</attachTime><deleteOnTermination>true</deleteOnTermination></attachment>
+      %(association)s
+      <privateIpAddressesSet><item><privateIpAddress>10.0.0.%(n)d</privateIpAddress><primary>true</primary></item>
+      </privateIpAddressesSet>
+    </item>
+  </networkInterfaceSet>
+  <iamInstanceProfile><arn>arn:aws:iam::123456789012:instance-profile/app</arn><id>AIPA%(n)08x</id></iamInstanceProfile>
+  <ebsOptimized>%(ebs_optimized)s</ebsOptimized>
+</item>'''
+
+ASSOCIATION = '''<association><publicIp>203.0.113.%(n)d</publicIp>
+      <publicDnsName>ec2-203-0-113-%(n)d.compute-1.amazonaws.com</publicDnsName><ipOwnerId>amazon</ipOwnerId></association>'''
+
+
+def describe_instances_response():
+    ''' A DescribeInstances response with an instance that has a public IP
+    address and one that doesn't '''
+
+    instances = []
+    for n, public in ((1, True), (2, False)):
+        values = {'n': n, 'dns_name': '', 'ip_address': '', 'association': '', 'monitoring': 'disabled',
+                  'source_dest_check': 'true', 'ebs_optimized': 'false'}
+        if public:
+            values.update(dns_name='ec2-203-0-113-%d.compute-1.amazonaws.com' % n,
+                          ip_address='<ipAddress>203.0.113.%d</ipAddress>' % n,
+                          association=ASSOCIATION % {'n': n}, monitoring='enabled',
+                          source_dest_check='false', ebs_optimized='true')
+        instances.append(INSTANCE % values)
+    return ('<DescribeInstancesResponse><reservationSet><item><reservationId>r-00000001</reservationId>'
+            '<ownerId>123456789012</ownerId><groupSet/><instancesSet>%s</instancesSet></item></reservationSet>'
+            '</DescribeInstancesResponse>' % ''.join(instances)).encode('utf-8')
+
+
+def parse_with_boto(response):
+    ''' Returns the reservations boto makes of response '''
+
+    import boto.ec2
+    import boto.handler
+    from boto.ec2.instance import Reservation
+    from boto.resultset import ResultSet
+
+    connection = boto.ec2.connect_to_region('us-east-1', aws_access_key_id='key', aws_secret_access_key='secret')
+    reservations = ResultSet([('item', Reservation)])
+    xml.sax.parseString(response, boto.handler.XmlHandler(reservations, connection))
+    return reservations
+
+
+def parse_with_botocore(response):
+    ''' Returns the describe_instances page boto3 makes of response '''
+
+    import botocore.parsers
+    import botocore.session
+
+    operation = botocore.session.get_session().get_service_model('ec2').operation_model('DescribeInstances')
+    return botocore.parsers.create_parser('ec2').parse(
+        {'body': response, 'headers': {}, 'status_code': 200}, operation.output_shape)
+
+
+class FakePaginator(object):
+    ''' Returns the pages it was given, or raises error, and records the
+    filters of each call '''
+
+    def __init__(self, pages, error=None):
+        self.pages = pages
+        self.error = error
+        self.filters = []
+
+    def paginate(self, **kwargs):
+        self.filters.append(kwargs.get('Filters'))
+        if self.error is not None:
+            raise self.error
+        return iter(self.pages)
+
+
+class FakeEC2Client(object):
+    ''' Answers describe_instances with page, and describe_tags with the
+    tags of its instances, or raises error '''
+
+    def __init__(self, page, error=None):
+        self.page = page
+        self.error = error
+        self.paginator = FakePaginator([page], error)
+
+    def get_paginator(self, operation):
+        if operation == 'describe_tags':
+            tags = [dict(tag, ResourceId=instance['InstanceId'])
+                    for reservation in self.page['Reservations']
+                    for instance in reservation['Instances'] for tag in instance.get('Tags', [])]
+            return FakePaginator([{'Tags': tags}])
+        return self.paginator
+
+
+class Boto3BackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.response = describe_instances_response()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_ini(self, backend):
+        directory = os.path.join(self.directory, backend)
+        os.mkdir(directory)
+        return write_ini(directory, 'instance_fetch_backend = %s\n' % backend)
+
+    def run_with_client(self, client, *args):
+        module = load_ec2_module()
+        module.Ec2Inventory.connect_to_aws_boto3 = lambda self, service, region, account=None: client
+        ini_path = os.path.join(self.directory, 'boto3', 'ec2.ini')
+        if not os.path.exists(ini_path):
+            self.write_ini('boto3')
+        return run_inventory(module, ini_path, args)
+
+    def test_same_inventory_as_boto(self):
+        connection = FakeEC2Connection(parse_with_boto(self.response))
+        expected = json.loads(run_inventory(load_ec2_module(), self.write_ini('boto'), ['--refresh-cache'],
+                                            connection))
+        inventory = json.loads(self.run_with_client(FakeEC2Client(parse_with_botocore(self.response)),
+                                                    '--refresh-cache'))
+        self.assertEqual(sorted(inventory['_meta']['hostvars']), ['10.0.0.1', '10.0.0.2'])
+        for hostname, hostvars in expected['_meta']['hostvars'].items():
+            self.assertEqual(inventory['_meta']['hostvars'][hostname], hostvars)
+        self.assertEqual(inventory, expected)
+
+    def test_host_not_in_cache(self):
+        page = parse_with_botocore(self.response)
+        cached_page = dict(page, Reservations=[dict(page['Reservations'][0],
+                                                    Instances=page['Reservations'][0]['Instances'][:1])])
+        self.run_with_client(FakeEC2Client(cached_page), '--refresh-cache')
+
+        client = FakeEC2Client(page)
+        hostvars = json.loads(self.run_with_client(client, '--host', '10.0.0.2'))
+        self.assertEqual(hostvars['ec2_id'], 'i-00000002')
+        self.assertEqual(client.paginator.filters, [[{'Name': 'private-ip-address', 'Values': ['10.0.0.2']}]])
+
+    def assert_fails_with(self, error, message):
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            with self.assertRaises(SystemExit) as raised:
+                self.run_with_client(FakeEC2Client(parse_with_botocore(self.response), error), '--refresh-cache')
+        self.assertEqual(raised.exception.code, 1)
+        self.assertIn(message, err.getvalue())
+        self.assertIn('while: getting EC2 instances', err.getvalue())
+
+    def test_no_credentials(self):
+        self.assert_fails_with(NoCredentialsError(), 'Authentication error retrieving ec2 inventory.')
+
+    def test_endpoint_connection_error(self):
+        self.assert_fails_with(EndpointConnectionError(endpoint_url='https://ec2.us-east-1.amazonaws.com'),
+                               'Error connecting to AWS backend.')
+
+
+if __name__ == '__main__':
+    unittest.main()
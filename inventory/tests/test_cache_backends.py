@@ -0,0 +1,291 @@
+''' The SQLite and Redis cache backends. The Redis ones run against
+RedisStandIn, a local server that speaks enough of the protocol. '''
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from support import load_ec2_module
+
+ec2 = load_ec2_module()
+
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    ''' Answers the commands of one client, queueing them between MULTI and
+    EXEC like Redis does '''
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        command = []
+        for i in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def handle(self):
+        queued = None
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            self.server.commands.append(command)
+            name = command[0].upper()
+            if name == b'MULTI':
+                queued = []
+                self.wfile.write(b'+OK\r\n')
+            elif name == b'EXEC':
+                replies = [self.server.run(queued_command) for queued_command in queued]
+                queued = None
+                self.wfile.write(b'*%d\r\n' % len(replies) + b''.join(replies))
+            elif queued is not None:
+                queued.append(command)
+                self.wfile.write(b'+QUEUED\r\n')
+            else:
+                self.wfile.write(self.server.run(command))
+
+
+class RedisStandIn(socketserver.ThreadingTCPServer):
+    ''' Keeps keys in a dict, with their expiry time, and records every
+    command it receives '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), RedisStandInHandler)
+        self.keys = {}
+        self.commands = []
+        self.lock = threading.Lock()
+        # Polls often, so that stop() doesn't hold up every test
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'redis://127.0.0.1:%d' % self.server_address[1]
+
+    def get(self, key):
+        value, expires = self.keys.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            del self.keys[key]
+            return None
+        return value
+
+    def run(self, command):
+        name, args = command[0].upper(), command[1:]
+        with self.lock:
+            if name in (b'AUTH', b'SELECT'):
+                return b'+OK\r\n'
+            if name == b'GET':
+                value = self.get(args[0])
+                return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+            if name == b'EXISTS':
+                return b':%d\r\n' % (self.get(args[0]) is not None)
+            if name == b'DEL':
+                return b':%d\r\n' % (self.keys.pop(args[0], None) is not None)
+            if name == b'SET':
+                options = [arg.upper() for arg in args[2:]]
+                expires = None
+                if b'PX' in options:
+                    expires = time.time() + int(args[2 + options.index(b'PX') + 1]) / 1000.0
+                if b'NX' in options and self.get(args[0]) is not None:
+                    return b'$-1\r\n'
+                self.keys[args[0]] = (args[1], expires)
+                return b'+OK\r\n'
+            return b'-ERR unknown command ' + name + b'\r\n'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RedisReplyTest(unittest.TestCase):
+
+    def read(self, data):
+        connection = ec2.RedisConnection('127.0.0.1', 6379)
+        connection.reader = io.BytesIO(data)
+        return connection.read_reply()
+
+    def test_reply_types(self):
+        self.assertEqual(self.read(b'+OK\r\n'), b'OK')
+        self.assertEqual(self.read(b':42\r\n'), 42)
+        self.assertEqual(self.read(b'$5\r\nhe\r\nl\r\n'), b'he\r\nl')
+        self.assertEqual(self.read(b'$0\r\n\r\n'), b'')
+        self.assertIsNone(self.read(b'$-1\r\n'))
+        self.assertIsNone(self.read(b'*-1\r\n'))
+        self.assertEqual(self.read(b'*3\r\n+OK\r\n*2\r\n:1\r\n$1\r\nx\r\n$-1\r\n'), [b'OK', [1, b'x'], None])
+
+    def test_error_reply(self):
+        error = self.read(b'-ERR wrong type\r\n')
+        self.assertIsInstance(error, ec2.RedisError)
+        self.assertEqual(str(error), 'ERR wrong type')
+
+    def test_truncated_reply(self):
+        self.assertRaises(IOError, self.read, b'+OK')
+        self.assertRaises(IOError, self.read, b'?what\r\n')
+
+
+class RedisCacheBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RedisStandIn()
+        self.backend = ec2.RedisCacheBackend(self.server.url, 'ansible-ec2-test')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_publish_and_get(self):
+        self.backend.publish([('cache', b'{"a": 1}', 60), ('index', io.BytesIO(b'{}'), None)])
+        self.assertEqual(self.backend.get('cache'), b'{"a": 1}')
+        self.assertEqual(self.backend.open('index').read(), b'{}')
+        self.assertLess(self.backend.age('cache'), 5)
+        self.assertIsNone(self.backend.get('missing'))
+        self.assertIsNone(self.backend.age('missing'))
+
+    def test_publish_is_one_transaction(self):
+        self.server.commands = []
+        self.backend.publish([('cache', b'1', 60), ('index', b'2', 60)])
+        names = [command[0] for command in self.server.commands]
+        self.assertEqual(names, [b'MULTI', b'SET', b'SET', b'SET', b'SET', b'EXEC'])
+        self.assertEqual(self.server.commands[1][1:3], [b'ansible-ec2-test:cache', b'1'])
+
+    def test_publish_date(self):
+        # ttl counts from the publish date, so only 0.2s of it are left
+        published = time.time() - 59.8
+        self.backend.publish([('cache', b'1', 60), ('index', b'2', None)], published)
+        self.assertGreater(self.backend.age('cache'), 59)
+        time.sleep(0.4)
+        self.assertIsNone(self.backend.get('cache'))
+        self.assertIsNone(self.backend.age('cache'))
+        self.assertEqual(self.backend.get('index'), b'2')
+
+    def test_lock(self):
+        other = ec2.RedisCacheBackend(self.server.url, 'ansible-ec2-test')
+        self.assertTrue(self.backend.try_lock())
+        self.assertFalse(other.try_lock())
+        # Only the holder can release it
+        other.unlock()
+        self.assertFalse(other.try_lock())
+        self.backend.unlock()
+        self.assertTrue(other.try_lock())
+
+    def test_lock_lease(self):
+        # A holder that died lets go of the lock when its lease runs out
+        self.backend.lock_lease = 1
+        self.assertTrue(self.backend.try_lock())
+        self.assertEqual(self.server.commands[-1][3:], [b'NX', b'PX', b'1000'])
+        other = ec2.RedisCacheBackend(self.server.url, 'ansible-ec2-test')
+        with other.lock(0.3) as locked:
+            self.assertFalse(locked)
+        time.sleep(1)
+        with other.lock(0.3) as locked:
+            self.assertTrue(locked)
+        self.assertTrue(self.backend.try_lock())
+
+    def test_auth_and_select(self):
+        url = self.server.url.replace('redis://', 'redis://:secret@') + '/2'
+        backend = ec2.RedisCacheBackend(url, 'ansible-ec2-test')
+        self.server.commands = []
+        backend.get('cache')
+        self.assertEqual(self.server.commands, [[b'AUTH', b'secret'], [b'SELECT', b'2'],
+                                                [b'GET', b'ansible-ec2-test:cache']])
+
+    def test_errors(self):
+        self.assertRaises(ec2.CacheBackendError, self.backend.redis.execute, 'FLUSHALL')
+        self.assertRaises(ec2.CacheBackendError, ec2.RedisCacheBackend, 'http://localhost', 'x')
+
+        # Nothing listens on a port that was just closed
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        backend = ec2.RedisCacheBackend('redis://127.0.0.1:%d' % port, 'ansible-ec2-test')
+        self.assertRaises(ec2.CacheBackendError, backend.get, 'cache')
+
+
+class FailingReader(object):
+    ''' Data of an entry that fails half way through publish '''
+
+    def read(self):
+        raise IOError("disk on fire")
+
+
+class SqliteCacheBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.backend = ec2.SqliteCacheBackend(self.path, 'ansible-ec2-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_publish_and_get(self):
+        self.backend.publish([('cache', b'{"a": 1}', 60), ('index', io.BytesIO(b'{}'), None)])
+        self.assertEqual(self.backend.get('cache'), b'{"a": 1}')
+        self.assertEqual(self.backend.open('index').read(), b'{}')
+        self.assertLess(self.backend.age('cache'), 5)
+        self.assertIsNone(self.backend.get('missing'))
+
+    def test_publish_date(self):
+        self.backend.publish([('cache', b'1', 60), ('index', b'2', None)], time.time() - 100)
+        self.assertIsNone(self.backend.get('cache'))
+        self.assertIsNone(self.backend.age('cache'))
+        self.assertGreater(self.backend.age('index'), 99)
+
+    def test_publish_is_all_or_none(self):
+        self.backend.publish([('cache', b'old', None)])
+        self.assertRaises(IOError, self.backend.publish, [('cache', b'new', None), ('index', FailingReader(), None)])
+        self.assertEqual(self.backend.get('cache'), b'old')
+        self.assertIsNone(self.backend.get('index'))
+
+    def test_namespaces(self):
+        other = ec2.SqliteCacheBackend(self.path, 'ansible-ec2-other')
+        self.backend.publish([('cache', b'1', None)])
+        other.publish([('cache', b'2', None)])
+        self.assertEqual(self.backend.get('cache'), b'1')
+        self.assertEqual(other.get('cache'), b'2')
+        self.assertTrue(self.backend.try_lock())
+        self.assertTrue(other.try_lock())
+
+    def test_lock(self):
+        other = ec2.SqliteCacheBackend(self.path, 'ansible-ec2-test')
+        self.assertTrue(self.backend.try_lock())
+        self.assertFalse(other.try_lock())
+        # Only the holder can release it
+        other.unlock()
+        self.assertFalse(other.try_lock())
+        self.backend.unlock()
+        with other.lock(0.3) as locked:
+            self.assertTrue(locked)
+            self.assertFalse(self.backend.try_lock())
+        self.assertTrue(self.backend.try_lock())
+
+    def test_lock_lease(self):
+        # A holder that died lets go of the lock when its lease runs out
+        self.backend.lock_lease = 0
+        self.assertTrue(self.backend.try_lock())
+        other = ec2.SqliteCacheBackend(self.path, 'ansible-ec2-test')
+        self.assertTrue(other.try_lock())
+        self.assertFalse(self.backend.try_lock())
+
+    def test_unusable_database(self):
+        path = os.path.join(self.directory, 'missing', 'cache.db')
+        self.assertRaises(ec2.CacheBackendError, ec2.SqliteCacheBackend, path, 'ansible-ec2-test')
+
+
+if __name__ == '__main__':
+    unittest.main()
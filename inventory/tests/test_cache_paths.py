@@ -0,0 +1,38 @@
+''' Ini files sharing a cache_path keep their own cache when they differ in
+a setting that changes the inventory '''
+
+import shutil
+import tempfile
+import unittest
+
+from support import load_ec2_module, new_inventory, write_ini
+
+
+class CachePathsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.module = load_ec2_module()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def cache_names(self, extra=''):
+        inventory = new_inventory(self.module, write_ini(self.directory, extra))
+        return inventory.cache_backend.name, inventory.serve_socket
+
+    def test_same_settings(self):
+        self.assertEqual(self.cache_names(), self.cache_names())
+
+    def test_settings_that_change_the_inventory(self):
+        default = self.cache_names()
+        for extra in ['instance_fetch_backend = boto3\n',
+                      'tag_resolution = trust_describe\n',
+                      'nested_groups = True\n']:
+            names = self.cache_names(extra)
+            self.assertNotEqual(names[0], default[0], extra)
+            self.assertNotEqual(names[1], default[1], extra)
+
+
+if __name__ == '__main__':
+    unittest.main()
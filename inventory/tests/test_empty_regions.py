@@ -0,0 +1,84 @@
+''' With skip_empty_regions, a region is only left out of later refreshes if
+none of its sources found anything, including the sources added from their
+snapshot '''
+
+import contextlib
+import io
+import shutil
+import tempfile
+import time
+import unittest
+
+from support import FakeEC2Connection, FakeRDSConnection, load_ec2_module, make_reservations, new_inventory, write_ini
+
+
+class UnreachableEC2Connection(object):
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        raise IOError('unreachable')
+
+
+class EmptyRegionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.module = load_ec2_module()
+        self.module.Ec2Inventory.connect_to_aws = lambda self, service, region, account=None: FakeRDSConnection()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_ini(self, extra=''):
+        # RDS is refreshed more often than EC2, so it is fetched while EC2 is
+        # added from its snapshot
+        self.ini_path = write_ini(self.directory, 'skip_empty_regions = True\n'
+                                  'ec2_cache_max_age = 600\nrds_cache_max_age = 1\n' + extra, rds='True')
+
+    def refresh(self, connection):
+        ''' Refreshes the cache with connection answering the EC2 calls, and
+        returns the hosts of the inventory '''
+
+        self.module.Ec2Inventory.connect = lambda self, region, account=None: connection
+        inventory = new_inventory(self.module, self.ini_path)
+        with contextlib.redirect_stderr(io.StringIO()):
+            inventory.do_api_calls_update_cache()
+        return sorted(inventory.index)
+
+    def test_source_from_snapshot(self):
+        self.write_ini()
+        connection = FakeEC2Connection(make_reservations(6))
+        hosts = self.refresh(connection)
+        self.assertEqual(len(hosts), 6)
+        time.sleep(1.1)
+        self.assertEqual(self.refresh(connection), hosts)
+        self.assertEqual(connection.calls, 2)
+        self.assertFalse(self.region_is_empty())
+        self.assertEqual(self.refresh(connection), hosts)
+
+    def test_account_snapshot(self):
+        self.write_ini('\n[account:prod]\nboto_profile = prod\n')
+        connection = FakeEC2Connection(make_reservations(6))
+        hosts = self.refresh(connection)
+        self.assertEqual(len(hosts), 6)
+        time.sleep(1.1)
+        # EC2 snapshots of accounts don't expire, so it is fetched again, and
+        # fails
+        self.assertEqual(self.refresh(UnreachableEC2Connection()), hosts)
+        self.assertEqual(self.refresh(connection), hosts)
+
+    def region_is_empty(self):
+        return new_inventory(self.module, self.ini_path).load_regions_state()['us-east-1']['empty']
+
+    def test_empty_region(self):
+        self.write_ini()
+        connection = FakeEC2Connection([])
+        self.assertEqual(self.refresh(connection), [])
+        self.assertTrue(self.region_is_empty())
+        time.sleep(1.1)
+        # Both the fetched source and the snapshot are empty
+        self.refresh(connection)
+        self.assertTrue(self.region_is_empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+''' With nested_groups = True, groups like 'instances' get a child per host;
+adding one must not scan the children already there, or building the
+inventory grows with the square of the number of hosts.
+
+Run this file directly to print the timings of add_instances_by_region. '''
+
+import gc
+import shutil
+import tempfile
+import time
+import unittest
+
+from support import load_ec2_module, make_reservations, new_inventory, write_ini
+
+# Host counts timed, smallest to largest
+HOST_COUNTS = (2000, 4000, 8000, 16000)
+
+# Most the time per host may grow from the smallest to the largest count.
+# Before GroupChildren it grew more than 3 times (about 170 to 570us); since
+# then it has stayed within 1.2 times.
+MAX_GROWTH = 2.0
+
+
+class CountingName(str):
+    ''' A group name that counts how often it is compared for equality '''
+
+    comparisons = 0
+
+    def __eq__(self, other):
+        CountingName.comparisons += 1
+        return str.__eq__(self, other)
+
+    __hash__ = str.__hash__
+
+
+def time_add_instances(ini_path, reservations, runs=3):
+    ''' Returns the best time of runs builds of the inventory of
+    reservations '''
+
+    module = load_ec2_module()
+    best = None
+    for run in range(runs):
+        inventory = new_inventory(module, ini_path)
+        inventory.aws_account_id = reservations[0].owner_id
+        # Like timeit, keep the garbage collector's passes out of the times
+        gc.disable()
+        try:
+            started = time.time()
+            inventory.add_instances_by_region('us-east-1', reservations)
+            elapsed = time.time() - started
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_host_counts(ini_path, host_counts=HOST_COUNTS):
+    ''' Returns the time per host of building the inventory of each number
+    of hosts in host_counts '''
+
+    return [time_add_instances(ini_path, make_reservations(count)) / count for count in host_counts]
+
+
+class GroupScalingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ini_path = write_ini(self.directory, 'nested_groups = True\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_push_group_does_not_scan_children(self):
+        inventory = new_inventory(load_ec2_module(), self.ini_path)
+        children = [CountingName('i-%08x' % n) for n in range(2000)]
+        CountingName.comparisons = 0
+        for child in children + children:
+            inventory.push_group(inventory.inventory, 'instances', child)
+        self.assertEqual(inventory.inventory['instances']['children'], children)
+        # A scan would compare each child with the ones before it
+        self.assertLess(CountingName.comparisons, 2 * len(children))
+
+    def test_time_per_host_stays_flat(self):
+        per_host = time_host_counts(self.ini_path)
+        self.assertLess(per_host[-1], per_host[0] * MAX_GROWTH,
+                        ', '.join('%d hosts: %.0fus' % (count, seconds * 1e6)
+                                  for count, seconds in zip(HOST_COUNTS, per_host)))
+
+
+if __name__ == '__main__':
+    directory = tempfile.mkdtemp()
+    try:
+        ini_path = write_ini(directory, 'nested_groups = True\n')
+        print('   hosts  time/host')
+        for count, seconds in zip(HOST_COUNTS, time_host_counts(ini_path)):
+            print('%8d  %6.0fus' % (count, seconds * 1e6))
+    finally:
+        shutil.rmtree(directory)
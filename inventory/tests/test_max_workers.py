@@ -0,0 +1,66 @@
+''' max_workers bounds the AWS calls in flight, including the tag chunks
+fetched from within the fetch of a region '''
+
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from support import FakeEC2Connection, load_ec2_module, make_reservations, run_inventory, write_ini
+
+REGIONS = ['us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1']
+
+
+class CountingEC2Connection(FakeEC2Connection):
+    ''' Records the largest number of calls that were running at once '''
+
+    def __init__(self, reservations):
+        FakeEC2Connection.__init__(self, reservations)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def call(self, method, *args, **kwargs):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(0.02)
+            return method(self, *args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def get_all_instances(self, instance_ids=None, filters=None):
+        return self.call(FakeEC2Connection.get_all_instances, instance_ids, filters)
+
+    def get_all_tags(self, filters=None):
+        return self.call(FakeEC2Connection.get_all_tags, filters)
+
+
+class MaxWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_nested_calls(self):
+        module = load_ec2_module()
+        # Four chunks of tags for each region
+        module.Ec2Inventory.max_filter_value = 3
+        connection = CountingEC2Connection(make_reservations(12))
+        ini_path = write_ini(self.directory, 'max_workers = 3\n', regions=','.join(REGIONS))
+
+        inventory = json.loads(run_inventory(module, ini_path, ['--refresh-cache'], connection))
+
+        self.assertEqual(len(inventory['_meta']['hostvars']), 12)
+        self.assertEqual(connection.calls, len(REGIONS) * 5)
+        self.assertEqual(connection.peak, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+''' A run answered from a warm cache must not import the AWS libraries, and
+must stay fast '''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from support import EC2_PY, FakeEC2Connection, load_ec2_module, make_reservations, run_inventory, write_ini
+
+# Wall time of a whole cache hit, interpreter start included. The median
+# --list of 50 hosts took 0.12s (0.02s of it python -c pass) when this was
+# recorded; the budget leaves room for slow CI machines.
+STARTUP_BUDGET = 1.0
+
+# Runs ec2.py like python would, then reports the AWS modules it loaded
+REPORT_AWS_MODULES = '''
+import runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+finally:
+    loaded = sorted(name for name in sys.modules if name.split('.')[0] in ('boto', 'boto3', 'botocore'))
+    sys.stderr.write('\\nAWS modules: %s\\n' % ' '.join(loaded))
+'''
+
+
+class CacheHitStartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ini_path = write_ini(self.directory)
+        self.connection = FakeEC2Connection(make_reservations(50))
+        self.inventory = run_inventory(load_ec2_module(), self.ini_path, ['--refresh-cache'], self.connection)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_script(self, *args, **env):
+        environment = dict(os.environ, EC2_INI_PATH=self.ini_path, **env)
+        started = time.time()
+        process = subprocess.Popen([sys.executable, '-c', REPORT_AWS_MODULES, EC2_PY] + list(args),
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+        out, err = process.communicate()
+        elapsed = time.time() - started
+        err = err.decode('utf-8')
+        self.assertEqual(process.returncode, 0, err)
+        loaded = err.rsplit('AWS modules:', 1)[1].split()
+        return out.decode('utf-8'), loaded, elapsed
+
+    def test_list(self):
+        out, loaded, elapsed = self.run_script('--list')
+        self.assertEqual(json.loads(out), json.loads(self.inventory))
+        self.assertEqual(loaded, [])
+        self.assertLess(elapsed, STARTUP_BUDGET)
+
+    def test_host(self):
+        out, loaded, elapsed = self.run_script('--host', 'app-7')
+        self.assertEqual(json.loads(out)['ec2_id'], 'i-00000007')
+        self.assertEqual(loaded, [])
+        self.assertLess(elapsed, STARTUP_BUDGET)
+
+    def test_startup_budget_setting(self):
+        # The script's own check, for CI runs of the real thing
+        out, loaded, elapsed = self.run_script('--list', EC2_STARTUP_BUDGET=str(STARTUP_BUDGET))
+        self.assertEqual(loaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()